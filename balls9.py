@@ -27,18 +27,22 @@ import Tkinter as tk
 import math
 import random
 import array
-import pyaudio
+import heapq
 import time
 import tune
+import sinks
+import metrics
+import tracing
+import collide
+try:
+    import numpy as np
+    import raster
+except ImportError:
+    np = None
+    raster = None
 
 
-def Elastic(m1, m2, v1, v2):
-    """Returns a tuple of the velocities resulting from a perfectly
-    elastic collision between masses m1 traveling at v1 and m2
-    traveling at v2.  This simultaneously conserves momentum and energy."""
-    vp2 =  ((m2 * v2) + (m1 * ((2.0 * v1) - v2))) / (m1 + m2)
-    vp1 = vp2 + v2 - v1
-    return vp1, vp2
+Elastic = collide.Elastic
 
 
 class Ball(object):
@@ -63,6 +67,7 @@ class Ball(object):
         self.m = size
         self.old_e = 0.0
         self.image = None
+        self.drawn_color = None
         self.mom_n = 127
         self.e_n = 127
         self.e_gain_n = 127
@@ -109,41 +114,46 @@ class Ball(object):
                  (self.mom_n, self.e_n, self.e_gain_n)).replace(' ', '0')
         return color
 
-    def UpdatePosition(self, canvas, oradius, ocenter_x, ocenter_y):
+    def Advance(self):
+        """Move this ball along the track by one time step."""
         self.angle = math.fmod(self.angle + self.v, 2.0 * math.pi)
+
+    def Position(self, oradius, ocenter_x, ocenter_y):
         x = (oradius * math.cos(self.angle)) + ocenter_x
         y = (oradius * math.sin(self.angle)) + ocenter_y
+        return x, y
+
+    def UpdatePosition(self, canvas, oradius, ocenter_x, ocenter_y):
+        self.Advance()
+        x, y = self.Position(oradius, ocenter_x, ocenter_y)
         self.Draw(canvas, x, y)
 
     def Draw(self, canvas, x, y):
-        canvas.delete(self.image)
+        """Draw the ball centered at x, y.  The canvas item is created on
+        the first call and moved on later ones; its color is only sent to
+        Tk when it has changed."""
         x0 = x - self.radius
         y0 = y - self.radius
         x1 = x + self.radius
         y1 = y + self.radius
         col = self.MakeColor()
-        self.image = canvas.create_oval(x0, y0, x1, y1, fill=col, outline=col)
+        if tracing.enabled:
+            tracing.Begin('Ball.Draw')
+        if self.image is None:
+            self.image = canvas.create_oval(x0, y0, x1, y1, fill=col,
+                                            outline=col)
+        else:
+            canvas.coords(self.image, x0, y0, x1, y1)
+            if col != self.drawn_color:
+                canvas.itemconfigure(self.image, fill=col, outline=col)
+        self.drawn_color = col
+        if tracing.enabled:
+            tracing.End('Ball.Draw')
 
     def WillCollide(self, other):
         """Determine if this ball will collide with other ball in the next
         time step."""
-        pi2 = 2.0 * math.pi
-        piby2 = math.pi * 0.5
-        if self.angle < 0.0:
-            sa = pi2 + self.angle
-        else:
-            sa = self.angle
-        if other.angle < 0.0:
-            oa = pi2 + other.angle
-        else:
-            oa = other.angle
-        if (sa < piby2) and (oa > math.pi):
-            sa += pi2
-        elif (oa < piby2) and (sa > math.pi):
-            oa += pi2
-        t1 = sa - oa
-        t2 = sa + self.v - (oa + other.v)
-        return (t1 * t2) <= 0.0
+        return collide.WillMeet(self.angle, self.v, other.angle, other.v)
 
     def Collide(self, other):
         """If this ball will collide with other ball in the next time step,
@@ -157,10 +167,454 @@ class Ball(object):
         return None
 
 
-class Orbits(object):
+def LowerIndices(pairs):
+    """Return the lower index of each of pairs, as a sorted list without
+    repeats.  As in Ball.Collide(), only that ball of each impact records
+    its energy from before the impact, in old_e."""
+    return sorted(set([min(a, b) for a, b in pairs]))
+
+
+def RecordSolver(solver):
+    """Record the work done by a ChainSolver in the last time step."""
+    metrics.Observe('balls.collision_passes', solver.n_sweeps, 1.0)
+    metrics.Count('balls.collisions', solver.n_impulses)
+    if solver.failed:
+        print 'Collision Failure'
+        metrics.Count('balls.collision_failures')
+
+
+def ArrayProperty(name):
+    """Make a property that reads and writes element ind of the array
+    store.<name>."""
+    def Get(self):
+        return getattr(self.store, name)[self.ind]
+    def Set(self, value):
+        getattr(self.store, name)[self.ind] = value
+    return property(Get, Set)
+
+
+class BallView(Ball):
+    """A lightweight stand-in for a Ball whose state lives in a
+    BallArray.  All of the Ball methods work on it unchanged."""
+    angle = ArrayProperty('angle')
+    v = ArrayProperty('v')
+    m = ArrayProperty('m')
+    old_e = ArrayProperty('old_e')
+    radius = ArrayProperty('radius')
+    mom_n = ArrayProperty('mom_n')
+    e_n = ArrayProperty('e_n')
+    e_gain_n = ArrayProperty('e_gain_n')
+    ball_ind = ArrayProperty('ball_ind')
+    image = ArrayProperty('images')
+    drawn_color = ArrayProperty('drawn_colors')
+    color = ArrayProperty('colors')
+    master = ArrayProperty('masters')
+
+    def __init__(self, store, ind):
+        self.store = store
+        self.ind = ind
+
+
+class BallArray(object):
+    """Keeps the state of a population of Balls in contiguous numpy
+    arrays, so that motion, collision detection, the elastic velocity
+    exchange and the color normalization run as vectorized operations.
+    views holds a BallView for each ball."""
+
+    def __init__(self, balls):
+        n = len(balls)
+        self.n = n
+        self.angle = np.array([b.angle for b in balls], dtype=np.float64)
+        self.v = np.array([b.v for b in balls], dtype=np.float64)
+        self.m = np.array([b.m for b in balls], dtype=np.float64)
+        self.old_e = np.array([b.old_e for b in balls], dtype=np.float64)
+        self.radius = np.array([b.radius for b in balls], dtype=np.int64)
+        self.mom_n = np.array([b.mom_n for b in balls], dtype=np.int64)
+        self.e_n = np.array([b.e_n for b in balls], dtype=np.int64)
+        self.e_gain_n = np.array([b.e_gain_n for b in balls], dtype=np.int64)
+        self.ball_ind = [b.ball_ind for b in balls]
+        self.images = [b.image for b in balls]
+        self.drawn_colors = [b.drawn_color for b in balls]
+        self.colors = [b.color for b in balls]
+        self.masters = [b.master for b in balls]
+        self.views = [BallView(self, i) for i in range(n)]
+        self.solver = collide.ChainSolver()
+
+    def Advance(self):
+        self.angle = np.fmod(self.angle + self.v, 2.0 * math.pi)
+
+    def WillCollide(self, first, second):
+        """The vectorized version of Ball.WillCollide() for the pairs of
+        balls indexed by the arrays first and second."""
+        pi2 = 2.0 * math.pi
+        piby2 = math.pi * 0.5
+        sa = self.angle[first]
+        oa = self.angle[second]
+        sa = np.where(sa < 0.0, sa + pi2, sa)
+        oa = np.where(oa < 0.0, oa + pi2, oa)
+        wrap_s = (sa < piby2) & (oa > math.pi)
+        wrap_o = (oa < piby2) & (sa > math.pi) & ~wrap_s
+        sa = np.where(wrap_s, sa + pi2, sa)
+        oa = np.where(wrap_o, oa + pi2, oa)
+        t1 = sa - oa
+        t2 = sa + self.v[first] - (oa + self.v[second])
+        return (t1 * t2) <= 0.0
+
+    def UpdateColors(self, inds):
+        """The vectorized version of Ball.UpdateColor() for the balls
+        indexed by inds.  The ranges are shared with Ball."""
+        v = self.v[inds]
+        m = self.m[inds]
+        mom = v * m
+        Ball.mom_high = max(Ball.mom_high, mom.max())
+        Ball.mom_low = min(Ball.mom_low, mom.min())
+        e = 0.5 * v * v * m
+        Ball.e_high = max(Ball.e_high, e.max())
+        e_gain = np.abs(e - self.old_e[inds])
+        Ball.e_gain_high = max(Ball.e_gain_high, e_gain.max())
+        Ball.e_gain_low = min(Ball.e_gain_low, e_gain.min())
+        e_gain_range = Ball.e_gain_high - Ball.e_gain_low
+        mom_range = Ball.mom_high - Ball.mom_low
+        e_range = Ball.e_high - Ball.e_low
+        self.mom_n[inds] = np.clip(((mom - Ball.mom_low) * 256.0 /
+                                    mom_range).astype(np.int64), 0, 255)
+        self.e_n[inds] = np.clip(((e - Ball.e_low) * 256.0 /
+                                  e_range).astype(np.int64), 0, 255)
+        self.e_gain_n[inds] = np.clip(((e_gain - Ball.e_gain_low) * 256.0 /
+                                       e_gain_range).astype(np.int64), 0, 255)
+
+    def Approaching(self, first, second):
+        """True for the pairs indexed by first and second in which the
+        first ball is the faster, within the tolerance of the solver."""
+        v1 = self.v[first]
+        v2 = self.v[second]
+        return (v1 - v2) > 1.0e-12 * (np.abs(v1) + np.abs(v2))
+
+    def ResolveCollisions(self):
+        """Detect all collisions between angular neighbours that will
+        happen in the next time step, with one vectorized test.  Pairs that
+        share no ball with another colliding pair exchange velocities in
+        one vectorized step; only chains of touching pairs, and pairs that
+        those exchanges bring into contact, go to the chain solver (see
+        collide.py).  Returns a set of the indices of all balls that
+        collided."""
+        collided = set([])
+        n = self.n
+        if n < 2:
+            return collided
+        pi2 = 2.0 * math.pi
+        order = np.argsort(np.mod(self.angle, pi2), kind='mergesort')
+        behind = order
+        ahead = np.roll(order, -1)
+        # As in collide.RingPairs(), leave out a gap of over half the track.
+        far = np.nonzero(np.mod(self.angle[ahead] - self.angle[behind], pi2)
+                         > math.pi)[0]
+        closed = not len(far)
+        if not closed:
+            behind = np.roll(behind, -(far[0] + 1))[:n - 1]
+            ahead = np.roll(ahead, -(far[0] + 1))[:n - 1]
+        contact = self.WillCollide(behind, ahead)
+        hit = contact & self.Approaching(behind, ahead)
+        if not hit.any():
+            return collided
+        if closed:
+            contact_before = np.roll(contact, 1)
+            contact_after = np.roll(contact, -1)
+        else:
+            contact_before = np.concatenate(([False], contact[:-1]))
+            contact_after = np.concatenate((contact[1:], [False]))
+        single = hit & ~contact_before & ~contact_after
+        first = behind[single]
+        second = ahead[single]
+        v1 = self.v[first]
+        v2 = self.v[second]
+        self.v[first], self.v[second] = Elastic(self.m[first],
+                                                self.m[second], v1, v2)
+        inds = np.concatenate((first, second))
+        v0 = np.concatenate((v1, v2))
+        lower = np.minimum(first, second)
+        e0 = 0.5 * self.m[lower] * np.where(first < second, v1, v2) ** 2
+        if len(first):
+            metrics.Count('balls.collisions', len(first))
+        # The chains, and any pair that those exchanges brought into
+        # contact, are left to the solver.
+        if ((contact | self.WillCollide(behind, ahead)) &
+            self.Approaching(behind, ahead)).any():
+            pairs = list(zip(behind.tolist(), ahead.tolist()))
+            angles = self.angle.tolist()
+            v = self.v.tolist()
+            before = self.solver.Resolve(pairs, self.m.tolist(), v,
+                                         lambda b, b2:
+                                         collide.WillMeet(angles[b], v[b],
+                                                          angles[b2], v[b2]),
+                                         np.nonzero(contact)[0].tolist(),
+                                         dict(zip(inds.tolist(),
+                                                  v0.tolist())),
+                                         np.nonzero(single)[0].tolist())
+            RecordSolver(self.solver)
+            lower = LowerIndices(list(self.solver.struck) +
+                                 list(zip(first.tolist(), second.tolist())))
+            inds = np.array(list(before.keys()))
+            self.v[inds] = [v[i] for i in inds]
+            v0 = np.array([before[i] for i in lower])
+            lower = np.array(lower, dtype=np.int64)
+            e0 = 0.5 * self.m[lower] * v0 * v0
+        else:
+            # One pass for the exchanges and one for the check after them.
+            metrics.Observe('balls.collision_passes', 2, 1.0)
+        self.old_e[lower] = e0
+        self.UpdateColors(inds)
+        collided.update([self.ball_ind[i] for i in inds])
+        return collided
+
+
+class CollisionScheduler(object):
+    """Event-driven collision engine for Balls in the circular track.
+    Between impacts each ball moves at constant angular velocity, so the
+    time at which two neighbouring balls will meet can be computed in
+    advance.  Predicted impacts are kept in a priority queue ordered by
+    time; after an impact only the predictions involving the two balls
+    concerned are replaced.  Balls never pass through each other, so
+    their order around the track never changes.  Time is measured in
+    time steps, the unit of Ball.v."""
+
+    def __init__(self, balls):
+        self.balls = balls
+        self.time = 0.0
+        self.n = len(balls)
+        pi2 = 2.0 * math.pi
+        self.order = sorted(range(self.n), key=lambda i: balls[i].angle % pi2)
+        self.slot = [0 for i in range(self.n)]
+        for k in range(self.n):
+            self.slot[self.order[k]] = k
+        # Unwrapped angle of each ball at time t_last.  Following order,
+        # these never decrease and span less than one revolution.
+        self.pos = [ball.angle % pi2 for ball in balls]
+        self.t_last = [0.0 for i in range(self.n)]
+        self.counts = [0 for i in range(self.n)]
+        self.queue = []
+        self.n_events = 0
+        self.max_events = 1000 * max(1, self.n)
+        if self.n > 1:
+            for k in range(self.n):
+                self.Predict(k)
+
+    def PositionAt(self, i, t):
+        return self.pos[i] + (self.balls[i].v * (t - self.t_last[i]))
+
+    def Predict(self, k):
+        """Queue the next impact, if any, between the ball in slot k and
+        the ball that follows it around the track."""
+        a = self.order[k]
+        b = self.order[(k + 1) % self.n]
+        closing = self.balls[a].v - self.balls[b].v
+        if closing <= 0.0:
+            return
+        gap = self.PositionAt(b, self.time) - self.PositionAt(a, self.time)
+        if k == self.n - 1:
+            gap += 2.0 * math.pi
+        t_hit = self.time + (max(gap, 0.0) / closing)
+        heapq.heappush(self.queue, (t_hit, a, b, self.counts[a],
+                                    self.counts[b]))
+
+    def Collide(self, a, b):
+        """Implement the impact of balls a and b at the current time."""
+        for i in (a, b):
+            self.pos[i] = self.PositionAt(i, self.time)
+            self.t_last[i] = self.time
+        # Keep the convention of Ball.Collide(), where the ball with the
+        # lower index records its energy before the impact.
+        first, second = self.balls[min(a, b)], self.balls[max(a, b)]
+        first.old_e = first.m * first.v * first.v * 0.5
+        first.v, second.v = Elastic(first.m, second.m, first.v, second.v)
+        first.UpdateColor()
+        second.UpdateColor()
+        self.counts[a] += 1
+        self.counts[b] += 1
+        ka = self.slot[a]
+        self.Predict((ka - 1) % self.n)
+        self.Predict(ka)
+        self.Predict((ka + 1) % self.n)
+
+    def Advance(self, n_steps=1.0):
+        """Run the balls forward by n_steps time steps, implementing every
+        impact on the way, and update their angles.  Returns a set of the
+        indices of all balls that collided."""
+        t_end = self.time + n_steps
+        collided = set([])
+        n_events = 0
+        while self.queue and self.queue[0][0] <= t_end:
+            t_hit, a, b, count_a, count_b = heapq.heappop(self.queue)
+            if (count_a != self.counts[a]) or (count_b != self.counts[b]):
+                continue
+            self.time = max(self.time, t_hit)
+            self.Collide(a, b)
+            collided.update([self.balls[a].ball_ind, self.balls[b].ball_ind])
+            n_events += 1
+            if n_events > self.max_events:
+                print 'Collision Failure'
+                metrics.Count('balls.collision_failures')
+                self.queue = []
+                break
+        self.n_events += n_events
+        if n_events:
+            metrics.Observe('balls.collision_events', n_events, 1.0)
+            metrics.Count('balls.collisions', n_events)
+        self.time = t_end
+        pi2 = 2.0 * math.pi
+        for i in range(self.n):
+            self.balls[i].angle = math.fmod(self.PositionAt(i, t_end), pi2)
+        if self.n and abs(self.pos[self.order[0]]) > (4.0 * pi2):
+            shift = pi2 * math.floor(self.pos[self.order[0]] / pi2)
+            self.pos = [p - shift for p in self.pos]
+        return collided
+
+
+class Ring(object):
+    """Runs the physics of a collection of Balls in a circular track,
+    without any display."""
+
+    def __init__(self, balls=None):
+        if balls is None:
+            balls = []
+        self.balls = balls
+        self.event_driven = False
+        self.scheduler = None
+        self.neighbours_only = True
+        self.order = []
+        self.solver = collide.ChainSolver()
+        self.array_backed = False
+        self.store = None
+
+    def SetArrayBacked(self, array_backed=True):
+        """Keep the ball state in a BallArray and step it with vectorized
+        operations.  self.balls then holds BallViews."""
+        if array_backed and np is None:
+            sys.stderr.write('numpy is not available; balls are not '
+                             'array backed.\n')
+            array_backed = False
+        self.array_backed = array_backed
+        self.MakeStore()
+
+    def MakeStore(self):
+        if self.array_backed and self.balls:
+            self.store = BallArray(self.balls)
+            self.balls = self.store.views
+        else:
+            self.store = None
+
+    def SetEventDriven(self, event_driven=True):
+        """Choose between checking every pair of balls at every time step
+        and the event-driven CollisionScheduler."""
+        self.event_driven = event_driven
+        self.scheduler = None
+
+    def StepEvents(self):
+        if not self.scheduler:
+            self.scheduler = CollisionScheduler(self.balls)
+        return self.scheduler.Advance(1.0)
+
+    def CandidatePairs(self):
+        """Return the pairs of ball indices that could collide in the next
+        time step.  On the track a ball can only hit its angular neighbours,
+        so unless neighbours_only is turned off only adjacent balls, and the
+        last and first, are paired, as (behind, ahead) in track order (see
+        collide.RingPairs()).  The angular order rarely changes between
+        steps, so re-sorting it is close to linear."""
+        n = len(self.balls)
+        if not self.neighbours_only:
+            return [(b, b2) for b in range(n - 1) for b2 in range(b + 1, n)]
+        if len(self.order) != n:
+            self.order = list(range(n))
+        pi2 = 2.0 * math.pi
+        angles = [ball.angle % pi2 for ball in self.balls]
+        self.order.sort(key=angles.__getitem__)
+        return collide.RingPairs(self.order, angles)
+
+    def ResolveCollisions(self):
+        """Detect all collisions that will happen in the next time step and
+        resolve them chain by chain (see collide.py).  Returns a set of the
+        indices of all balls that collided."""
+        if not self.neighbours_only:
+            return self.ResolvePairs()
+        balls = self.balls
+        pairs = self.CandidatePairs()
+        hits = [k for k in range(len(pairs))
+                if balls[pairs[k][0]].WillCollide(balls[pairs[k][1]])]
+        collided = set([])
+        if not hits:
+            return collided
+        before = self.solver.Resolve(pairs, collide.AttributeList(balls, 'm'),
+                                     collide.AttributeList(balls, 'v'),
+                                     lambda b, b2:
+                                     balls[b].WillCollide(balls[b2]),
+                                     hits)
+        RecordSolver(self.solver)
+        for i in LowerIndices(self.solver.struck):
+            ball = balls[i]
+            ball.old_e = 0.5 * ball.m * before[i] * before[i]
+        for i in before:
+            ball = balls[i]
+            ball.UpdateColor()
+            collided.add(ball.ball_ind)
+        return collided
+
+    def ResolvePairs(self):
+        """Check every pair of balls for a collision in the next time step,
+        in up to five passes.  Used when neighbours_only is off."""
+        count = 0
+        collided = set([])
+        pairs = self.CandidatePairs()
+        while count < 5:
+            collisions = 0
+            for b, b2 in pairs:
+                did_collide = self.balls[b].Collide(self.balls[b2])
+                if did_collide:
+                    collisions += 1
+                    collided.update(did_collide)
+            metrics.Count('balls.collisions', collisions)
+            count += 1
+            if count > 4:
+                print 'Collision Failure'
+                metrics.Count('balls.collision_failures')
+            if not collisions:
+                break
+        if collided:
+            metrics.Observe('balls.collision_passes', count, 1.0)
+        return collided
+
+    def UpdatePositions(self):
+        """Run the ball collection for one time step.  Returns a set of
+        all balls that collided."""
+        if self.event_driven:
+            return self.StepEvents()
+        if self.store:
+            self.store.Advance()
+            return self.store.ResolveCollisions()
+        for ball in self.balls:
+            ball.Advance()
+        return self.ResolveCollisions()
+
+    def ClobberBalls(self):
+        self.balls = []
+        self.scheduler = None
+        self.store = None
+
+    def AddBalls(self, new_balls):
+        self.balls.extend(new_balls)
+        self.balls[0].ResetRanges()
+        self.scheduler = None
+        self.MakeStore()
+
+
+class Orbits(Ring):
     """Manages a collection of Balls running in a circular track."""
 
-    def __init__(self, root, size, interval, balls=[], music=None):
+    def __init__(self, root, size, interval, balls=[], music=None,
+                 renderer='items'):
+        """renderer is 'items', for one canvas item per ball, or 'raster',
+        to draw all the balls into one image (see raster.py)."""
+        Ring.__init__(self, balls)
         self.master = root
         self.music = music
         self.frame = tk.Frame(root)
@@ -168,51 +622,201 @@ class Orbits(object):
         self.canvas = tk.Canvas(self.frame, width=size, height=size,
                                 background='#303030')
         self.canvas.pack()
-        self.balls = balls
         self.interval = interval
         self.radius = size * 0.3
         self.center_x = size * 0.5
         self.center_y = size * 0.5
         self.is_running = False
         self.after_id = None
+        self.background = '#303030'
+        self.raster = None
+        if renderer == 'raster':
+            if raster is None:
+                sys.stderr.write('numpy is not available; using canvas '
+                                 'items.\n')
+            else:
+                self.raster = raster.Raster(self.canvas, size, size,
+                                            self.background)
+        self.SetFixedTimestep(False)
+
+    def BallPositions(self, angles=None):
+        """Return lists, or arrays, of the x and y coordinates of the balls
+        at angles, which default to their current angles."""
+        if angles is None:
+            if self.store:
+                angles = self.store.angle
+            else:
+                angles = [ball.angle for ball in self.balls]
+        if np is not None and isinstance(angles, np.ndarray):
+            xs = (self.radius * np.cos(angles)) + self.center_x
+            ys = (self.radius * np.sin(angles)) + self.center_y
+            return xs, ys
+        xs = [(self.radius * math.cos(a)) + self.center_x for a in angles]
+        ys = [(self.radius * math.sin(a)) + self.center_y for a in angles]
+        return xs, ys
+
+    def DrawBalls(self, angles=None):
+        """Bring the canvas up to date with the balls' state, in one pass
+        per frame.  angles, if given, overrides the angles at which the
+        balls are drawn."""
+        xs, ys = self.BallPositions(angles)
+        if self.raster:
+            for i in range(len(self.balls)):
+                ball = self.balls[i]
+                self.raster.Disc(i, xs[i], ys[i], ball.radius,
+                                 (ball.mom_n, ball.e_n, ball.e_gain_n))
+            self.raster.Render()
+            return
+        for i in range(len(self.balls)):
+            self.balls[i].Draw(self.canvas, xs[i], ys[i])
+
+    def UpdateBackground(self):
+        """Set the background color of the display as an ad hoc function
+        of the system state."""
+        n = len(self.balls)
+        r = b = g = 0
+        for ball in self.balls:
+            g += ball.e_n
+            r += ball.mom_n
+            b += ball.e_gain_n
+        r /= n
+        g /= n
+        b /= n
+        bg =  ('#%2x%2x%2x' % (r, g, b)).replace(' ', '0')
+        if bg != self.background:
+            if self.raster:
+                self.raster.SetBackground(bg)
+            else:
+                self.canvas.configure(background=bg)
+            self.background = bg
 
     def UpdatePositions(self):
         """Run the ball collection for one time step, detect any collisions,
         and adjust the background color of the display as an ad hoc function
         of the system state.  Returns a set of all balls that collided."""
-        for ball in self.balls:
-            ball.UpdatePosition(self.canvas, self.radius, self.center_x,
-                                self.center_y)
-        count = 0
+        if tracing.enabled:
+            tracing.Begin('Orbits.UpdatePositions')
+        time1 = time.time()
+        collided = Ring.UpdatePositions(self)
+        time2 = time.time()
+        self.DrawBalls()
+        if collided:
+            self.UpdateBackground()
+        metrics.Observe('balls.step_time', time2 - time1)
+        metrics.Observe('balls.draw_time', time.time() - time2)
+        if tracing.enabled:
+            tracing.End('Orbits.UpdatePositions', {'hits': len(collided)})
+        return collided
+
+    def SetFixedTimestep(self, fixed=True, frame_rate=60.0, max_steps=10):
+        """Decouple the physics from the display.  The physics then
+        advances in steps of exactly self.interval of wall-clock time,
+        several per frame when it has fallen behind but at most max_steps,
+        while the display is redrawn frame_rate times a second with the
+        balls drawn part way between their last two positions."""
+        self.fixed_step = fixed
+        self.frame_interval = 1.0 / frame_rate
+        self.max_steps = max_steps
+        self.ResetFrameStats()
+
+    def ResetFrameStats(self):
+        self.accumulator = 0.0
+        self.last_time = None
+        self.next_frame = None
+        self.n_frames = 0
+        self.n_steps = 0
+        self.n_late_frames = 0
+        self.n_capped_frames = 0
+        self.n_dropped_steps = 0
+        self.last_overrun = 0.0
+        self.prev_angles = None
+
+    def FrameStats(self):
+        """Return the fixed timestep counters: frames drawn, physics steps
+        taken, frames whose work took longer than a frame, frames that hit
+        max_steps, steps dropped to catch up and the lateness of the last
+        frame in seconds."""
+        return {'frames': self.n_frames, 'steps': self.n_steps,
+                'late_frames': self.n_late_frames,
+                'capped_frames': self.n_capped_frames,
+                'dropped_steps': self.n_dropped_steps,
+                'last_overrun': self.last_overrun}
+
+    def Frame(self):
+        """Run the physics steps due since the last frame, then draw."""
+        if tracing.enabled:
+            tracing.Begin('Orbits.Frame')
+        now = time.time()
+        if self.last_time is None:
+            self.last_time = now
+            self.next_frame = now
+        self.accumulator += now - self.last_time
+        self.last_time = now
+        self.last_overrun = max(0.0, now - self.next_frame)
+        pi2 = 2.0 * math.pi
+        steps = 0
         collided = set([])
-        while count < 5:
-            collisions = 0
-            for b in range(len(self.balls) - 1):
-                for b2 in range(b + 1, len(self.balls)):
-                    did_collide = self.balls[b].Collide(self.balls[b2])
-                    if did_collide:
-                        collisions += 1
-                        collided.update(did_collide)
-            count += 1
-            if count > 4:
-                print 'Collision Failure'
-            if not collisions:
-                break
+        while (self.accumulator >= self.interval) and (steps < self.max_steps):
+            # The state before the last step is kept across frames, so that
+            # frames that run no step still interpolate.
+            if self.store:
+                self.prev_angles = self.store.angle.copy()
+            else:
+                self.prev_angles = [ball.angle for ball in self.balls]
+            hit_balls = Ring.UpdatePositions(self)
+            for ball_ind in hit_balls:
+                self.music.Ping(ball_ind)
+            collided.update(hit_balls)
+            self.accumulator -= self.interval
+            steps += 1
+        time2 = time.time()
+        if steps:
+            metrics.Observe('balls.step_time', (time2 - now) / steps)
+        if self.accumulator >= self.interval:
+            dropped = int(self.accumulator / self.interval)
+            self.n_dropped_steps += dropped
+            metrics.Count('balls.dropped_steps', dropped)
+            self.n_capped_frames += 1
+            self.accumulator -= dropped * self.interval
+        self.n_steps += steps
+        self.n_frames += 1
+        angles = None
+        prev = self.prev_angles
+        if (prev is not None) and (len(prev) == len(self.balls)):
+            alpha = self.accumulator / self.interval
+            if self.store:
+                delta = (np.mod(self.store.angle - prev + math.pi, pi2) -
+                         math.pi)
+                angles = prev + (alpha * delta)
+            else:
+                angles = []
+                for i in range(len(self.balls)):
+                    delta = (((self.balls[i].angle - prev[i] + math.pi) % pi2)
+                             - math.pi)
+                    angles.append(prev[i] + (alpha * delta))
+        self.DrawBalls(angles)
         if collided:
-            n = len(self.balls)
-            r = b = g = 0
-            for ball in self.balls:
-                g += ball.e_n
-                r += ball.mom_n
-                b += ball.e_gain_n
-            r /= n
-            g /= n
-            b /= n
-            bg =  ('#%2x%2x%2x' % (r, g, b)).replace(' ', '0')
-            self.canvas.configure(background=bg)
+            self.UpdateBackground()
+        done = time.time()
+        metrics.Observe('balls.draw_time', done - time2)
+        metrics.Observe('balls.frame_overrun', self.last_overrun)
+        if (done - now) > self.frame_interval:
+            self.n_late_frames += 1
+            metrics.Count('balls.late_frames')
+        self.next_frame += self.frame_interval
+        if self.next_frame < done:
+            self.next_frame = done
+        if tracing.enabled:
+            tracing.End('Orbits.Frame', {'steps': steps})
         return collided
-                
+
     def Increment(self):
+        if self.fixed_step:
+            self.Frame()
+            delay = self.next_frame - time.time()
+            self.after_id = self.master.after(max(1, int(delay * 1000)),
+                                              self.Increment)
+            return
         hit_balls = self.UpdatePositions()
         for ball_ind in hit_balls:
             self.music.Ping(ball_ind)
@@ -223,6 +827,7 @@ class Orbits(object):
         if self.is_running:
             return
         self.is_running = True
+        self.ResetFrameStats()
         self.after_id = self.master.after(int(self.interval * 1000),
                                           self.Increment)
 
@@ -231,13 +836,12 @@ class Orbits(object):
             self.master.after_cancel(self.after_id)
         self.after_id = None
         self.is_running = False
-        for ball in self.balls:
-            self.canvas.delete(ball.image)
-        self.balls = []
-
-    def AddBalls(self, new_balls):
-        self.balls.extend(new_balls)
-        self.balls[0].ResetRanges()
+        if self.raster:
+            self.raster.Clear()
+        else:
+            for ball in self.balls:
+                self.canvas.delete(ball.image)
+        Ring.ClobberBalls(self)
 
 
 class Baller(object):
@@ -246,7 +850,7 @@ class Baller(object):
     user-specified chord sequence.  The initial velocities and masses
     of the balls are chosen randomly."""
 
-    def __init__(self, root, orbit, interval, tonic='C3'):
+    def __init__(self, root, orbit, interval, tonic='C3', seed=None):
         self.master = root
         self.n_range = [3, 7]
         self.size_range = [20,100]
@@ -255,35 +859,43 @@ class Baller(object):
         self.orbit = orbit
         self.interval = int(interval * 1000)
         self.after_id = None
-        self.audio = pyaudio.PyAudio()
         self.tonic = tonic
         self.fs = 22050.0
-        self.music = tune.Music(self.audio, self.fs, self.tonic)
+        self.music = tune.Music(None, self.fs, self.tonic)
+        self.note_names = tune.Notes(self.tonic, 1)
+        self.rng = random.Random(seed)
+        self.music.tone_gen.SetSeed(seed)
         self.switch_int = 3000
         self.tone_dur = 1.0
         self.tone_decay = 0.2
         self.prog_step_i = 0
-        self.progression = ['I', 'vi', 'ii', 'IV', 'V']
-
+        self.renderer = 'items'
+        self.fixed_step = False
+        self.SetProgression(None)
 
     def SetProgression(self, prog_text):
+        """Use the progression prog_text, or the default if it is empty,
+        compiled ahead of time, with its ping tables for every number of
+        balls in n_range, in every key that CreateBalls() may pick."""
         if not prog_text:
             self.progression = ['I', 'vi', 'ii', 'IV', 'V']
         else:
             self.progression = prog_text
+        self.music.PrecomputeProgressions(
+            self.note_names.c_sharp_names, self.progression, 24,
+            range(self.n_range[0], self.n_range[1] + 1))
 
     def CreateBalls(self):
         col = 'red'
         n_balls = int(0.5 + ((self.n_range[1] -
-                              self.n_range[0]) * random.random()) +
+                              self.n_range[0]) * self.rng.random()) +
                       self.n_range[0])
         balls = []
-        self.music.StopAudioOutput()
         for i in range(n_balls):
             size = int(0.5 + ((self.size_range[1] -
-                               self.size_range[0]) * random.random()) +
+                               self.size_range[0]) * self.rng.random()) +
                        self.size_range[0])
-            v = (((self.v_range[1] - self.v_range[0]) * random.random()) +
+            v = (((self.v_range[1] - self.v_range[0]) * self.rng.random()) +
                  self.v_range[0])
             ball = Ball(self.master, size, col, self.starts[i], v)
             balls.append([size, ball])
@@ -296,8 +908,7 @@ class Baller(object):
         base_ind = int(0.5 + ((self.size_range[1] - balls[0].m) * 12.0 /
                               (self.size_range[1] - self.size_range[0])))
         # Now, find the note name that will become the tonic.
-        n = tune.Notes(self.tonic, 1)
-        self.tonic = n.GetNoteName(base_ind)
+        self.tonic = self.note_names.GetNoteName(base_ind)
         if self.music and self.music.print_progression:
             print 'Tonic:', self.tonic
         self.music.SetupProgression(self.progression, self.tonic, 24)
@@ -309,11 +920,12 @@ class Baller(object):
         self.after_id = None
         self.ProgressChord()
 
-    def ProgressChord(self):
+    def AdvanceChord(self):
         self.prog_step_i = (self.prog_step_i + 1) % len(self.progression)
-        self.music.ChangeChord(self.prog_step_i)
-        self.music.MakeChordCompatiblePingNotes(self.prog_step_i,
-                                                len(self.orbit.balls))
+        self.ChangeNotes()
+
+    def ProgressChord(self):
+        self.AdvanceChord()
         self.after_id = self.master.after(self.switch_int, self.ProgressChord)
 
     def ChangeNotes(self):
@@ -340,17 +952,17 @@ class Baller(object):
     def Restart(self, unused_event):
         self.master.after_cancel(self.after_id)
         self.after_id = None
-        self.music.StopAudioOutput()
         self.Start()
 
     def Start(self):
         if not self.orbit:
-            self.orbit = Orbits(self.master, 700, 0.01, music=self.music)
+            self.orbit = Orbits(self.master, 700, 0.01, music=self.music,
+                                renderer=self.renderer)
+            self.orbit.SetFixedTimestep(self.fixed_step)
         self.orbit.ClobberBalls()
         self.orbit.AddBalls(self.CreateBalls())
-        self.music.SetupAudioStream()
         self.ChangeNotes()
-        self.music.StartAudio()
+        self.music.OpenAudio()
         self.orbit.canvas.focus_set()
         self.orbit.canvas.bind('<Button-1>', self.Restart)
         self.orbit.canvas.bind('<Button-2>', self.ProgressChordEvent)
@@ -362,14 +974,108 @@ class Baller(object):
         self.orbit.Start()
 
 
+class HeadlessBaller(Baller):
+    """Runs the Baller without a display or an audio device.  The
+    physics advances on a simulated clock and the collision pings are
+    rendered, to the sample, into a WAV file."""
+
+    def __init__(self, interval=0.01, tonic='C3', seed=None):
+        Baller.__init__(self, None, Ring(), interval, tonic, seed)
+        self.step_time = interval
+
+    def Render(self, file_name, duration=60.0):
+        """Simulate duration seconds with a new random set of balls and
+        write the resulting sound to file_name.  Returns the number of
+        pings."""
+        self.orbit.ClobberBalls()
+        self.orbit.AddBalls(self.CreateBalls())
+        self.prog_step_i = 0
+        self.ChangeNotes()
+        writer = tune.WavWriter(file_name, self.fs)
+        switch_time = self.switch_int / 1000.0
+        next_switch = switch_time
+        n_pings = 0
+        for step in range(int(duration / self.step_time)):
+            t_sim = (step + 1) * self.step_time
+            hit_balls = self.orbit.UpdatePositions()
+            self.music.RenderSamples(writer, int(t_sim * self.fs) -
+                                     writer.n_written)
+            for ball_ind in hit_balls:
+                self.music.Ping(ball_ind)
+                n_pings += 1
+            if t_sim >= next_switch:
+                self.AdvanceChord()
+                next_switch += switch_time
+        writer.Close()
+        return n_pings
+
+
 def main(args):
+    args = args[:]
+    file_name = None
+    seed = None
+    duration = 60.0
+    renderer = 'items'
+    fixed_step = False
+    low_latency = False
+    lookahead = 0
+    sink_spec = 'pyaudio'
+    trace_name = None
+    while len(args) > 1 and args[1] in ['-o', '-s', '-t', '-r', '-f', '-l',
+                                        '-p', '-a', '-m', '-T']:
+        if args[1] == '-r':
+            renderer = 'raster'
+            del args[1]
+            continue
+        if args[1] == '-f':
+            fixed_step = True
+            del args[1]
+            continue
+        if args[1] == '-l':
+            low_latency = True
+            del args[1]
+            continue
+        if len(args) < 3:
+            break
+        if args[1] == '-o':
+            file_name = args[2]
+        elif args[1] == '-s':
+            seed = int(args[2])
+        elif args[1] == '-a':
+            sink_spec = args[2]
+        elif args[1] == '-p':
+            lookahead = int(args[2])
+        elif args[1] == '-m':
+            metrics.StartLog(args[2])
+        elif args[1] == '-T':
+            trace_name = args[2]
+            tracing.Enable()
+        else:
+            duration = float(args[2])
+        del args[1:3]
+    if file_name:
+        b = HeadlessBaller(tonic='C3', seed=seed)
+        if len(args) > 1:
+            b.SetProgression(args[1:])
+        b.Render(file_name, duration)
+        if trace_name:
+            tracing.Export(trace_name)
+        return
     root = tk.Tk()
     root.title(args[0])
-    b = Baller(root, None, 100.0, tonic='C3')
+    b = Baller(root, None, 100.0, tonic='C3', seed=seed)
+    b.renderer = renderer
+    b.fixed_step = fixed_step
+    b.music.SetSink(sinks.MakeSink(sink_spec))
+    if low_latency:
+        b.music.SetLowLatency()
+    b.music.SetProducer(lookahead)
     if len(args) > 1:
         b.SetProgression(args[1:])
     b.Start()
     root.mainloop()
+    if trace_name:
+        tracing.Export(trace_name)
 
 if __name__ == '__main__':
     main(sys.argv)
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+#
+"""Benchmarks for the synthesis, ball and pendulum hot paths.  Nothing
+is displayed or played.  Results are written as JSON and can be compared
+against a saved baseline:
+
+    bench.py -o baseline.json
+    ... change things ...
+    bench.py -b baseline.json
+
+With -b the exit status is 1 if any result is slower than the baseline
+by more than the tolerance (-x, default 0.1, i.e. 10%)."""
+#
+#
+# Copyright 2017 David Talkin.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+__author__ = 'dtalkin@gmail.com (David Talkin)'
+
+import sys
+import math
+import time
+import json
+import random
+import platform
+import threading
+import tune
+import balls9
+import pend
+
+
+def Rate(func, units_per_call, min_time=0.5):
+    """Call func() repeatedly for at least min_time seconds, after one
+    warm-up call, and return units_per_call * calls / second."""
+    func()
+    n_calls = 0
+    time1 = time.time()
+    elapsed = 0.0
+    while elapsed < min_time:
+        func()
+        n_calls += 1
+        elapsed = time.time() - time1
+    return units_per_call * n_calls / elapsed
+
+
+def Result(name, params, value, unit):
+    return {'name': name, 'params': params, 'value': value, 'unit': unit}
+
+
+def ResultKey(result):
+    params = ','.join(['%s=%s' % (k, result['params'][k])
+                       for k in sorted(result['params'])])
+    return '%s(%s)' % (result['name'], params)
+
+
+def MakeTones(n_voices, chord_engine='python', ping_engine='python'):
+    """A Tones object with n_voices chord notes and n_voices pings, all
+    sounding."""
+    tones = tune.Tones(22050.0)
+    tones.SetSeed(1)
+    notes = [110.0 * pow(2.0, i / 7.0) for i in range(n_voices)]
+    tones.ChangeChord(notes)
+    tones.SetChordEngine(chord_engine)
+    tones.SetPingEngine(ping_engine)
+    tones.SetupPings(notes, 0.5, 1000.0)
+    for i in range(n_voices):
+        tones.Ping(i)
+    return tones
+
+
+def BenchSynthesis(voices, min_time, n_samp=1024):
+    results = []
+    chord_engines = ['python', 'table']
+    ping_engines = ['python', 'resonator']
+    if tune.np is not None:
+        chord_engines.insert(1, 'numpy')
+    for n_voices in voices:
+        for engine in chord_engines:
+            tones = MakeTones(n_voices, chord_engine=engine)
+            rate = Rate(lambda: tones.GetSamples(n_samp), n_samp, min_time)
+            results.append(Result('Tones.GetSamples',
+                                  {'voices': n_voices, 'engine': engine},
+                                  rate, 'samples/s'))
+        for engine in ping_engines:
+            tones = MakeTones(n_voices, ping_engine=engine)
+            rate = Rate(lambda: tones.GeneratePingSignal(n_samp), n_samp,
+                        min_time)
+            results.append(Result('Tones.GeneratePingSignal',
+                                  {'voices': n_voices, 'engine': engine},
+                                  rate, 'samples/s'))
+    return results
+
+
+def MakeRing(n_balls, collisions, mode, seed=1):
+    """A Ring of n_balls evenly spaced balls.  With collisions the
+    velocities are random; without, all balls move together and never
+    meet."""
+    rng = random.Random(seed)
+    balls = []
+    for i in range(n_balls):
+        if collisions:
+            v = rng.uniform(-0.03, 0.03)
+        else:
+            v = 0.01
+        ball = balls9.Ball(None, rng.randint(20, 100), 'red',
+                           2.0 * math.pi * i / n_balls, v)
+        ball.ball_ind = i
+        balls.append(ball)
+    ring = balls9.Ring()
+    ring.AddBalls(balls)
+    if mode == 'array':
+        ring.SetArrayBacked(True)
+    elif mode == 'events':
+        ring.SetEventDriven(True)
+    return ring
+
+
+def BenchRing(counts, min_time, n_steps=10):
+    results = []
+    modes = ['list', 'events']
+    if balls9.np is not None:
+        modes.insert(1, 'array')
+    for n_balls in counts:
+        for collisions in [False, True]:
+            for mode in modes:
+                ring = MakeRing(n_balls, collisions, mode)
+                def Steps():
+                    for i in range(n_steps):
+                        ring.UpdatePositions()
+                rate = Rate(Steps, n_steps, min_time)
+                results.append(Result('Ring.UpdatePositions',
+                                      {'balls': n_balls, 'mode': mode,
+                                       'collisions': collisions},
+                                      rate, 'steps/s'))
+    return results
+
+
+def MakePendulums(n_pends, seed=1):
+    rng = random.Random(seed)
+    specs = [[rng.uniform(0.03, 0.15), 360.0 * i / n_pends, 'red']
+             for i in range(n_pends)]
+    return pend.Pendulums(specs, length=0.4, display=False)
+
+
+def BenchPendulums(counts, min_time, integrators=('euler',)):
+    """Run the physics thread flat out (paced with an rt_factor of 0) for
+    min_time seconds, and report its step rate."""
+    results = []
+    for n_pends in counts:
+        for integrator in integrators:
+            pends = MakePendulums(n_pends)
+            pends.SetIntegrator(integrator, 4)
+            pends.SetPacing(True, rt_factor=0.0)
+            thread = threading.Thread(group=None,
+                                      target=pends.RunPacedPendulums)
+            thread.start()
+            time1 = time.time()
+            time.sleep(min_time)
+            pends.paced = False
+            thread.join()
+            rate = pends.n_steps / (time.time() - time1)
+            results.append(Result('Pendulums.RunPendulums',
+                                  {'pendulums': n_pends,
+                                   'integrator': integrator},
+                                  rate, 'steps/s'))
+    return results
+
+
+def RunAll(quick=False):
+    if quick:
+        min_time = 0.1
+        voices, balls, pends = [1, 8], [8, 64], [3, 12]
+    else:
+        min_time = 0.5
+        voices, balls, pends = [1, 4, 16], [8, 64, 512], [3, 12, 48]
+    results = []
+    results.extend(BenchSynthesis(voices, min_time))
+    results.extend(BenchRing(balls, min_time))
+    results.extend(BenchPendulums(pends, min_time))
+    return {'python': platform.python_version(),
+            'numpy': tune.np is not None,
+            'time': time.time(), 'results': results}
+
+
+def Compare(report, baseline, tolerance=0.1):
+    """Print each result as a ratio to the same result in baseline, and
+    return the keys of those slower by more than tolerance."""
+    old = dict([(ResultKey(r), r['value']) for r in baseline['results']])
+    regressions = []
+    for result in report['results']:
+        key = ResultKey(result)
+        if key not in old:
+            sys.stderr.write('%-70s %12.1f  (new)\n' % (key, result['value']))
+            continue
+        ratio = result['value'] / max(old[key], 1.0e-9)
+        flag = ''
+        if ratio < 1.0 - tolerance:
+            flag = '  SLOWER'
+            regressions.append(key)
+        sys.stderr.write('%-70s %12.1f %6.2fx%s\n' % (key, result['value'],
+                                                      ratio, flag))
+    return regressions
+
+
+def main(args):
+    args = args[:]
+    out_name = None
+    baseline_name = None
+    tolerance = 0.1
+    quick = False
+    while len(args) > 1 and args[1] in ['-o', '-b', '-x', '-q']:
+        if args[1] == '-q':
+            quick = True
+            del args[1]
+            continue
+        if len(args) < 3:
+            break
+        if args[1] == '-o':
+            out_name = args[2]
+        elif args[1] == '-b':
+            baseline_name = args[2]
+        else:
+            tolerance = float(args[2])
+        del args[1:3]
+    if len(args) > 1:
+        sys.stderr.write('Usage: %s [-q] [-o <json file>] [-b <baseline '
+                         'json>] [-x <tolerance>]\n' % (args[0]))
+        return 2
+    # The physics may print warnings; keep them out of the JSON.
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    report = RunAll(quick)
+    sys.stdout = stdout
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if out_name:
+        with open(out_name, 'w') as out:
+            out.write(text + '\n')
+    elif not baseline_name:
+        print text
+    if baseline_name:
+        with open(baseline_name) as base:
+            baseline = json.load(base)
+        if Compare(report, baseline, tolerance):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
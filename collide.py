@@ -0,0 +1,266 @@
+#!/usr/bin/python
+#
+"""Collision resolution shared by the balls (balls9.py) and the
+pendulums (pend.py).  In both the bodies move along one circular track,
+so a body can only hit its angular neighbours, and a cluster of bodies
+that touch in the same time step forms a chain of neighbouring pairs.
+The chains are resolved by sweeping pairwise elastic impulses along
+them, alternately forwards and backwards, revisiting only the pairs
+next to one that was just struck, until no pair is still approaching."""
+#
+#
+# Copyright 2017 David Talkin.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+__author__ = 'dtalkin@gmail.com (David Talkin)'
+
+import math
+import metrics
+
+
+def Elastic(m1, m2, v1, v2):
+    """Returns a tuple of the velocities resulting from a perfectly
+    elastic collision between masses m1 traveling at v1 and m2
+    traveling at v2.  This simultaneously conserves momentum and energy."""
+    vp2 =  ((m2 * v2) + (m1 * ((2.0 * v1) - v2))) / (m1 + m2)
+    vp1 = vp2 + v2 - v1
+    return vp1, vp2
+
+
+def WillMeet(a1, v1, a2, v2):
+    """Determine if bodies at angles a1 and a2 on the track, moving by v1
+    and v2 radians per time step, will meet in the next time step."""
+    pi2 = 2.0 * math.pi
+    piby2 = math.pi * 0.5
+    if a1 < 0.0:
+        a1 += pi2
+    if a2 < 0.0:
+        a2 += pi2
+    if (a1 < piby2) and (a2 > math.pi):
+        a1 += pi2
+    elif (a2 < piby2) and (a1 > math.pi):
+        a2 += pi2
+    t1 = a1 - a2
+    t2 = a1 + v1 - (a2 + v2)
+    return (t1 * t2) <= 0.0
+
+
+def RingPairs(order, angles):
+    """Return the neighbouring pairs of the bodies listed in order, as
+    (behind, ahead) index tuples: each body with the next one, and the
+    last with the first.  angles must be in [0, 2 pi), and order must sort
+    them.  A gap of more than half the track can not be crossed in a
+    step, and is left out; the pairs then run from the body after it to
+    the body before it."""
+    n = len(order)
+    if n < 2:
+        return []
+    start = 0
+    n_pairs = n
+    if (angles[order[0]] + 2.0 * math.pi - angles[order[-1]]) <= math.pi:
+        for k in range(n - 1):
+            if (angles[order[k + 1]] - angles[order[k]]) > math.pi:
+                start = k + 1
+                n_pairs = n - 1
+                break
+    else:
+        n_pairs = n - 1
+    return [(order[(start + k) % n], order[(start + k + 1) % n])
+            for k in range(n_pairs)]
+
+
+class AttributeList(object):
+    """Presents attribute name of each of objs as an indexable list, so
+    that the solver can work on the bodies' own state."""
+
+    def __init__(self, objs, name):
+        self.objs = objs
+        self.name = name
+
+    def __len__(self):
+        return len(self.objs)
+
+    def __getitem__(self, i):
+        return getattr(self.objs[i], self.name)
+
+    def __setitem__(self, i, value):
+        setattr(self.objs[i], self.name, value)
+
+
+class ChainSolver(object):
+    """Resolves the collisions on a track in one time step.  Pairs are
+    given as (behind, ahead) in track order, a pair being in contact when
+    the two will meet within the step, and approaching when the body
+    behind is the faster.
+
+    Each sweep visits the pairs that may still be approaching, in track
+    order, alternately forwards and backwards, and gives each one that is
+    an elastic impulse.  An impulse can only start the two pairs either
+    side of it approaching, so those are the ones visited next: the pair
+    ahead, in the direction of the sweep, in the same sweep, and the one
+    behind in the next.  A chain of touching bodies is thus only ever
+    swept where its velocities changed, and a pair that comes into
+    contact joins it as soon as a neighbour is struck.
+
+    All the chains share one budget of max_sweeps sweeps (by default
+    twice the number of pairs plus eight), so the solver always
+    terminates; if pairs are still approaching by then it counts a
+    failure and leaves them for the next step.  Every impulse is an exact
+    pairwise elastic exchange, and with check on the total momentum and
+    energy of the bodies involved are compared before and after to within
+    tolerance, relative."""
+
+    def __init__(self, max_sweeps=None, check=True, tolerance=1.0e-9):
+        self.max_sweeps = max_sweeps
+        self.check = check
+        self.tolerance = tolerance
+        self.n_sweeps = 0
+        self.n_impulses = 0
+        self.struck = set([])
+        self.n_failures = 0
+        self.n_conservation_errors = 0
+        self.failed = False
+
+    def Sweep(self, dirty, forward, pairs, masses, velocities, contact,
+              touching, before, closed):
+        """Visit the pair positions in dirty in one direction, each pair
+        that receives an impulse being followed by the one ahead of it.
+        Positions in touching are known to be in contact; others are
+        checked with contact() and added if they are.  The first velocity
+        of each body that receives an impulse is kept in before.  Returns
+        the positions to visit in the next sweep."""
+        n_pairs = len(pairs)
+        if forward:
+            step = 1
+        else:
+            step = -1
+        seq = sorted(dirty, reverse=not forward)
+        n_seq = len(seq)
+        later = set([])
+        i = 0
+        k = None
+        while True:
+            if k is None:
+                if i >= n_seq:
+                    break
+                k = seq[i]
+                i += 1
+            behind, ahead = pairs[k]
+            v1 = velocities[behind]
+            v2 = velocities[ahead]
+            if (((v1 - v2) <= 1.0e-12 * (abs(v1) + abs(v2))) or
+                ((k not in touching) and not contact(behind, ahead))):
+                k = None
+                continue
+            touching.add(k)
+            if behind not in before:
+                before[behind] = v1
+            if ahead not in before:
+                before[ahead] = v2
+            velocities[behind], velocities[ahead] = Elastic(
+                masses[behind], masses[ahead], v1, v2)
+            self.n_impulses += 1
+            self.struck.add((behind, ahead))
+            back = k - step
+            if closed:
+                back %= n_pairs
+            if 0 <= back < n_pairs:
+                later.add(back)
+            # The pair ahead is visited next, unless that crosses the end.
+            k += step
+            if closed and not (0 <= k < n_pairs):
+                later.add(k % n_pairs)
+                k = None
+            elif not (0 <= k < n_pairs):
+                k = None
+            elif (i < n_seq) and (seq[i] == k):
+                i += 1
+        return later
+
+    def Conserved(self, bodies, masses, velocities, before):
+        """Compare the momentum and energy of bodies now with those from
+        the velocities in before (or now, for bodies not in it)."""
+        p0 = p1 = e0 = e1 = 0.0
+        for i in bodies:
+            m = masses[i]
+            v1 = velocities[i]
+            v0 = before.get(i, v1)
+            p0 += m * v0
+            p1 += m * v1
+            e0 += m * v0 * v0
+            e1 += m * v1 * v1
+        scale = sum([abs(masses[i] * before.get(i, velocities[i]))
+                     for i in bodies])
+        return ((abs(p1 - p0) <= self.tolerance * max(scale, 1.0e-300)) and
+                (abs(e1 - e0) <= self.tolerance * max(e0, 1.0e-300)))
+
+    def Resolve(self, pairs, masses, velocities, contact, hits, before=None,
+                struck=()):
+        """Resolve the collisions among pairs, which must go along the
+        track in order, pair k's ahead body being pair k+1's behind body,
+        as from RingPairs(); they are closed when the last pair's ahead
+        body is the first pair's behind body.  hits lists the positions in
+        pairs of those in contact, and velocities is updated in place.
+        contact(behind, ahead) is used to check whether a pair next to one
+        that received an impulse is now in contact too.  Returns a dict
+        from the index of each body that received an impulse to its
+        velocity before the step.  The pairs that received an impulse are
+        left in self.struck.
+
+        Impulses already given in this step, e.g. by a vectorized exchange
+        of pairs that share no body, are passed in as before, which is
+        then updated, with the positions of those pairs in struck; their
+        neighbours are visited just as if the first sweep had struck
+        them."""
+        n_pairs = len(pairs)
+        closed = (n_pairs > 1) and (pairs[-1][1] == pairs[0][0])
+        self.n_sweeps = 0
+        self.n_impulses = 0
+        self.struck = set([])
+        self.failed = False
+        if before is None:
+            before = {}
+        limit = self.max_sweeps or ((2 * n_pairs) + 8)
+        touching = set(hits)
+        dirty = set(hits)
+        later = set([])
+        for k in struck:
+            for j, queue in [(k + 1, dirty), (k - 1, later)]:
+                if closed:
+                    if (j < 0) or (j >= n_pairs):
+                        queue = later
+                    j %= n_pairs
+                elif (j < 0) or (j >= n_pairs):
+                    continue
+                queue.add(j)
+        forward = True
+        while dirty or later:
+            if self.n_sweeps >= limit:
+                self.failed = True
+                self.n_failures += 1
+                metrics.Count('collide.failures')
+                break
+            dirty = self.Sweep(dirty, forward, pairs, masses, velocities,
+                               contact, touching, before, closed)
+            dirty.update(later)
+            later = set([])
+            self.n_sweeps += 1
+            forward = not forward
+        if self.check and before:
+            bodies = list(before)
+            if not self.Conserved(bodies, masses, velocities, before):
+                self.n_conservation_errors += 1
+                metrics.Count('collide.conservation_errors')
+        return before
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+#
+"""Runtime counters and histograms.  The audio callback, the ball
+display loop and the pendulum physics record into the module-level
+registry; the values can be read in-process with Get() and Snapshot(),
+or appended to a log file periodically with StartLog().
+
+Recording is cheap and takes no locks, so it is safe in the audio
+callback.  A reader racing with a writer may see a histogram that is
+one observation behind, which is fine for monitoring.  Metrics recorded
+in another process (e.g. the pendulum worker) stay in that process.
+
+balls.collision_passes and pend.collision_passes get one observation
+per time step in which something collided, and none for other steps,
+whichever collision path is in use: the number of passes over the
+pairs, including the last, which finds none still approaching.  An
+isolated impact thus counts 2."""
+#
+#
+# Copyright 2017 David Talkin.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+__author__ = 'dtalkin@gmail.com (David Talkin)'
+
+import sys
+import time
+import json
+import atexit
+import bisect
+import threading
+
+
+class Histogram(object):
+    """Counts observations in fixed buckets whose upper bounds double from
+    low up to low * 2**(n_buckets - 1), plus one overflow bucket.  The
+    defaults span about a microsecond to a quarter of an hour, which suits
+    times in seconds and dimensionless ratios alike."""
+
+    def __init__(self, low=1.0e-6, n_buckets=30):
+        self.bounds = [low * (2.0 ** i) for i in range(n_buckets)]
+        self.counts = [0] * (n_buckets + 1)
+        self.n = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def Observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.n += 1
+        self.total += value
+        if (self.min is None) or (value < self.min):
+            self.min = value
+        if (self.max is None) or (value > self.max):
+            self.max = value
+
+    def Quantile(self, q):
+        """Return the upper bound of the bucket holding quantile q, or the
+        largest value seen if that is smaller."""
+        if not self.n:
+            return None
+        target = q * self.n
+        running = 0
+        for i in range(len(self.counts)):
+            running += self.counts[i]
+            if running >= target and self.counts[i]:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+    def Summary(self):
+        mean = None
+        if self.n:
+            mean = self.total / self.n
+        return {'count': self.n, 'mean': mean, 'min': self.min,
+                'max': self.max, 'p50': self.Quantile(0.5),
+                'p90': self.Quantile(0.9), 'p99': self.Quantile(0.99)}
+
+
+class Metrics(object):
+    """A named collection of counters and histograms, created on first
+    use."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.log_thread = None
+        self.logging = False
+        self.stop_at_exit = False
+
+    def Count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def Observe(self, name, value, low=1.0e-6):
+        """Add value to histogram name.  low sets the first bucket bound
+        when the histogram is created; use 1 for counts."""
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms.setdefault(name, Histogram(low))
+        hist.Observe(value)
+
+    def Get(self, name):
+        """Return the value of counter name, or the summary of histogram
+        name, or None if nothing has been recorded under name."""
+        if name in self.counters:
+            return self.counters[name]
+        if name in self.histograms:
+            return self.histograms[name].Summary()
+        return None
+
+    def Snapshot(self):
+        """Return all counters and histogram summaries in one dict."""
+        snap = {'time': time.time(), 'uptime': time.time() - self.started,
+                'counters': dict(self.counters), 'histograms': {}}
+        for name in list(self.histograms):
+            snap['histograms'][name] = self.histograms[name].Summary()
+        return snap
+
+    def Reset(self):
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def StartLog(self, file_name, interval=10.0):
+        """Append a Snapshot() to file_name, one JSON object per line,
+        every interval seconds until StopLog(), which is also called at
+        exit so that the last one is written."""
+        self.StopLog()
+        if not self.stop_at_exit:
+            atexit.register(self.StopLog)
+            self.stop_at_exit = True
+        self.logging = True
+        self.log_thread = threading.Thread(group=None, target=self.RunLog,
+                                           args=(file_name, interval))
+        self.log_thread.daemon = True
+        self.log_thread.start()
+
+    def StopLog(self):
+        self.logging = False
+        if self.log_thread:
+            self.log_thread.join()
+            self.log_thread = None
+
+    def Dump(self, file_name):
+        """Append one Snapshot() to file_name.  Returns False if it could
+        not be written."""
+        try:
+            with open(file_name, 'a') as log:
+                log.write(json.dumps(self.Snapshot(), sort_keys=True) + '\n')
+        except IOError as e:
+            sys.stderr.write('Cannot write metrics to %s: %s\n' %
+                             (file_name, e))
+            return False
+        return True
+
+    def RunLog(self, file_name, interval):
+        """Dump every interval seconds, and once more when stopped."""
+        next_dump = time.time() + interval
+        while True:
+            time.sleep(min(0.1, max(0.0, next_dump - time.time())))
+            stopping = not self.logging
+            if stopping or (time.time() >= next_dump):
+                next_dump += interval
+                if not self.Dump(file_name):
+                    break
+            if stopping:
+                break
+
+
+registry = Metrics()
+Count = registry.Count
+Observe = registry.Observe
+Get = registry.Get
+Snapshot = registry.Snapshot
+Reset = registry.Reset
+StartLog = registry.StartLog
+StopLog = registry.StopLog
@@ -25,6 +25,14 @@ import math
 import time
 import Tkinter as tk
 import threading
+import multiprocessing
+import metrics
+import tracing
+import collide
+try:
+    import raster
+except ImportError:
+    raster = None
 
 
 # Just remember: F = ma  ;-)
@@ -32,14 +40,11 @@ import threading
 g = 9.807  # m / (s*s)
 g = 1.0
 
+# The order of accuracy of each integrator that takes sub-steps.
+ORDERS = {'verlet': 2, 'rk4': 4}
 
-def Elastic(m1, m2, v1, v2):
-    """Returns a tuple of the velocities resulting from a perfectly
-    elastic collision between masses m1 traveling at v1 and m2
-    traveling at v2.  This simultaneously conserves momentum and energy."""
-    vp2 =  ((m2 * v2) + (m1 * ((2.0 * v1) - v2))) / (m1 + m2)
-    vp1 = vp2 + v2 - v1
-    return vp1, vp2
+
+Elastic = collide.Elastic
 
 
 def DegToRad(deg):
@@ -54,7 +59,9 @@ class Bob(object):
     """Creates and manages a graphical representation of a collection of
     pendulums."""
 
-    def __init__(self, width=700, height=700):
+    def __init__(self, width=700, height=700, renderer='items'):
+        """renderer is 'items', for canvas items per pendulum, or 'raster',
+        to draw all the pendulums into one image (see raster.py)."""
         self.root = tk.Tk()
         self.master = tk.Frame(self.root)
         self.master.pack(side=tk.TOP, expand=tk.YES, fill=tk.BOTH)
@@ -68,6 +75,14 @@ class Bob(object):
         self.pends = {}
         self.len_scale = min(height, width) * 1.1
         self.mass_scale = self.len_scale / 3.0
+        self.raster = None
+        if renderer == 'raster':
+            if raster is None:
+                sys.stderr.write('numpy is not available; using canvas '
+                                 'items.\n')
+            else:
+                self.raster = raster.Raster(self.canvas, width, height,
+                                            'black')
 
     def Quit(self, unused_event):
         pass
@@ -76,11 +91,11 @@ class Bob(object):
         pass
 
     def DrawPend(self, pend_id, angle, mass, length, color='red'):
-        if pend_id in self.pends:
-            pen, specs = self.pends.pop(pend_id)
-            self.canvas.delete(pen[0], pen[1])
-        pen = []
-        specs = [angle, mass, length, color]
+        """Draw the string and bob of pendulum pend_id.  Its canvas items
+        are created on the first call and moved on later ones; the color
+        is only sent to Tk when it has changed."""
+        if tracing.enabled:
+            tracing.Begin('Bob.DrawPend')
         x1 = self.width / 2
         y1 = self.height / 2
         radius = mass * self.mass_scale
@@ -90,10 +105,31 @@ class Bob(object):
         ya = y2 - radius
         xb = x2 + radius
         yb = y2 + radius
-        pen.append(self.canvas.create_line(x1,y1,x2,y2, fill=color))
-        pen.append(self.canvas.create_oval(xa,ya,xb,yb, fill=color,
-                                           outline=color))
-        self.pends[pend_id] = [pen, specs]
+        if self.raster:
+            self.raster.Line((pend_id, 'line'), x1, y1, x2, y2, color)
+            self.raster.Disc((pend_id, 'bob'), x2, y2, radius, color)
+        elif pend_id in self.pends:
+            pen, specs = self.pends[pend_id]
+            self.canvas.coords(pen[0], x1, y1, x2, y2)
+            self.canvas.coords(pen[1], xa, ya, xb, yb)
+            if color != specs[3]:
+                self.canvas.itemconfigure(pen[0], fill=color)
+                self.canvas.itemconfigure(pen[1], fill=color, outline=color)
+            specs[:] = [angle, mass, length, color]
+        else:
+            pen = []
+            specs = [angle, mass, length, color]
+            pen.append(self.canvas.create_line(x1,y1,x2,y2, fill=color))
+            pen.append(self.canvas.create_oval(xa,ya,xb,yb, fill=color,
+                                               outline=color))
+            self.pends[pend_id] = [pen, specs]
+        if tracing.enabled:
+            tracing.End('Bob.DrawPend')
+
+    def Render(self):
+        """Finish a frame of DrawPend() calls."""
+        if self.raster:
+            self.raster.Render()
         
         
         
@@ -115,34 +151,89 @@ class Pend(object):
         self.speed = 0.0
         self.del_t = delta_t
         self.sub_steps = 5
+        self.integrator = 'euler'
+        self.tolerance = None
+        self.max_sub_steps = 64
+
+    def SetIntegrator(self, integrator='euler', sub_steps=1, tolerance=None):
+        """Choose how Step() advances the pendulum by del_t:
+            'euler': semi-implicit Euler in one step (sub_steps is ignored).
+            'verlet': velocity Verlet (leapfrog), which is symplectic.
+            'rk4': classical fourth-order Runge-Kutta.
+        The latter two take sub_steps steps of del_t / sub_steps.  If
+        tolerance is given, sub_steps adapts so that the change in energy
+        over a step, relative to mass * g * length, stays below it."""
+        if integrator not in ['euler', 'verlet', 'rk4']:
+            sys.stderr.write('Unknown integrator (%s)\n' % (integrator))
+            return
+        self.integrator = integrator
+        self.sub_steps = sub_steps
+        self.tolerance = tolerance
+
+    def EnergyOf(self, angle, speed):
+        """Kinetic plus potential energy at angle and speed, with zero
+        potential energy at the height of the pivot."""
+        return ((0.5 * self.mass * speed * speed) -
+                (self.mass * g * self.length * math.sin(angle)))
+
+    def Energy(self):
+        return self.EnergyOf(self.angle, self.speed)
+
+    def Integrate(self, angle, speed, dt):
+        """Advance angle and speed by dt with the chosen integrator."""
+        if self.integrator == 'verlet':
+            speed += 0.5 * dt * g * math.cos(angle)
+            angle += speed * dt / self.length
+            speed += 0.5 * dt * g * math.cos(angle)
+            return angle, speed
+        length = self.length
+        k1a = speed / length
+        k1s = g * math.cos(angle)
+        k2a = (speed + (0.5 * dt * k1s)) / length
+        k2s = g * math.cos(angle + (0.5 * dt * k1a))
+        k3a = (speed + (0.5 * dt * k2s)) / length
+        k3s = g * math.cos(angle + (0.5 * dt * k2a))
+        k4a = (speed + (dt * k3s)) / length
+        k4s = g * math.cos(angle + (dt * k3a))
+        angle += dt * (k1a + (2.0 * k2a) + (2.0 * k3a) + k4a) / 6.0
+        speed += dt * (k1s + (2.0 * k2s) + (2.0 * k3s) + k4s) / 6.0
+        return angle, speed
 
     def Step(self):
-        f = self.mass * math.cos(self.angle) * g
-        a = f / self.mass
-        self.speed += a * self.del_t
-        del_ang = self.speed * self.del_t / self.length
-        self.angle = math.fmod(self.angle + del_ang, 2.0 * math.pi)
+        if self.integrator == 'euler':
+            f = self.mass * math.cos(self.angle) * g
+            a = f / self.mass
+            self.speed += a * self.del_t
+            del_ang = self.speed * self.del_t / self.length
+            self.angle = math.fmod(self.angle + del_ang, 2.0 * math.pi)
+            return
+        while True:
+            n = self.sub_steps
+            dt = self.del_t / n
+            angle = self.angle
+            speed = self.speed
+            for i in range(n):
+                angle, speed = self.Integrate(angle, speed, dt)
+            if self.tolerance is None:
+                break
+            err = (abs(self.EnergyOf(angle, speed) - self.Energy()) /
+                   (self.mass * g * self.length))
+            if (err > self.tolerance) and (n < self.max_sub_steps):
+                self.sub_steps = min(2 * n, self.max_sub_steps)
+                continue
+            band = 4.0 * (2 ** ORDERS[self.integrator])
+            # Halving the sub-step multiplies the error by 2 ** order, so
+            # it is only halved when that would stay well under tolerance.
+            if (err < (self.tolerance / band)) and (n > 1):
+                self.sub_steps = n // 2
+            break
+        self.speed = speed
+        self.angle = math.fmod(angle, 2.0 * math.pi)
 
     def WillCollide(self, other):
-        pi2 = 2.0 * math.pi
-        piby2 = math.pi * 0.5
-        if self.angle < 0.0:
-            sa = pi2 + self.angle
-        else:
-            sa = self.angle
-        if other.angle < 0.0:
-            oa = pi2 + other.angle
-        else:
-            oa = other.angle
-        if (sa < piby2) and (oa > math.pi):
-            sa += pi2
-        elif (oa < piby2) and (sa > math.pi):
-            oa += pi2
-        t1 = sa - oa
-        self_av = self.speed * self.del_t / self.length
-        other_av = other.speed * other.del_t / other.length
-        t2 = sa + self_av - (oa + other_av)
-        return (t1 * t2) <= 0.0
+        return collide.WillMeet(self.angle, self.speed * self.del_t /
+                                self.length, other.angle,
+                                other.speed * other.del_t / other.length)
 
     def Collide(self, other):
         if self.WillCollide(other):
@@ -152,57 +243,422 @@ class Pend(object):
         return False
         
 
+class SnapshotBuffer(object):
+    """Passes consistent copies of the pendulum state from the physics
+    thread to the drawing thread without locks.  The writer fills one of
+    n_buffers preallocated slots and then advances the published
+    sequence number; the reader copies the latest slot and checks that
+    the writer did not reuse it meanwhile."""
+
+    def __init__(self, n_pends, n_buffers=3):
+        self.n_buffers = n_buffers
+        self.slots = [[0, [0.0] * n_pends, [0.0] * n_pends, 0]
+                      for i in range(n_buffers)]
+        self.published = 0
+        self.read_seq = 0
+        self.steps = 0
+        self.n_read = 0
+        self.n_skipped = 0
+        self.n_torn = 0
+
+    def Publish(self, angles, speeds, steps=0):
+        seq = self.published + 1
+        slot = self.slots[seq % self.n_buffers]
+        slot[0] = -1
+        slot[1][:] = angles
+        slot[2][:] = speeds
+        slot[3] = steps
+        slot[0] = seq
+        self.published = seq
+
+    def Latest(self):
+        """Return (angles, speeds) from the most recent snapshot, or None
+        if nothing has been published since the last call."""
+        while True:
+            seq = self.published
+            if seq == self.read_seq:
+                return None
+            slot = self.slots[seq % self.n_buffers]
+            angles = list(slot[1])
+            speeds = list(slot[2])
+            steps = slot[3]
+            if slot[0] == seq:
+                break
+            self.n_torn += 1
+        self.n_skipped += seq - self.read_seq - 1
+        self.read_seq = seq
+        self.n_read += 1
+        self.steps = steps
+        return angles, speeds
+
+    def Stats(self):
+        """Return counts of snapshots published, read, never read because
+        a newer one was available, and reads retried because the slot was
+        overwritten during the copy."""
+        return {'published': self.published, 'read': self.n_read,
+                'skipped': self.n_skipped, 'torn': self.n_torn}
+
+
+class SharedSnapshotBuffer(object):
+    """A SnapshotBuffer whose slots live in shared memory, so that the
+    physics can run in another process.  Each slot is a fixed-layout
+    record of doubles: sequence number, step count, then the angle and
+    the speed of each pendulum."""
+
+    def __init__(self, n_pends, n_buffers=4):
+        self.n_pends = n_pends
+        self.n_buffers = n_buffers
+        self.rec_len = 2 + (2 * n_pends)
+        self.data = multiprocessing.RawArray('d', self.rec_len * n_buffers)
+        self.seq = multiprocessing.RawValue('l', 0)
+        self.read_seq = 0
+        self.steps = 0
+        self.n_read = 0
+        self.n_skipped = 0
+        self.n_torn = 0
+
+    def Publish(self, angles, speeds, steps=0):
+        seq = self.seq.value + 1
+        base = (seq % self.n_buffers) * self.rec_len
+        n = self.n_pends
+        self.data[base] = -1.0
+        self.data[base + 1] = steps
+        self.data[base + 2:base + 2 + n] = angles
+        self.data[base + 2 + n:base + 2 + (2 * n)] = speeds
+        self.data[base] = seq
+        self.seq.value = seq
+
+    def Latest(self):
+        """Return (angles, speeds) from the most recent snapshot, or None
+        if nothing has been published since the last call."""
+        n = self.n_pends
+        while True:
+            seq = self.seq.value
+            if seq == self.read_seq:
+                return None
+            base = (seq % self.n_buffers) * self.rec_len
+            record = self.data[base:base + self.rec_len]
+            # Publish() marks the slot first, so one rewritten during the
+            # copy no longer holds seq.
+            if (record[0] == seq) and (self.data[base] == seq):
+                break
+            self.n_torn += 1
+        self.n_skipped += seq - self.read_seq - 1
+        self.read_seq = seq
+        self.n_read += 1
+        self.steps = int(record[1])
+        return record[2:2 + n], record[2 + n:2 + (2 * n)]
+
+    def Stats(self):
+        return {'published': self.seq.value, 'read': self.n_read,
+                'skipped': self.n_skipped, 'torn': self.n_torn}
+
+
+def PendulumWorker(pends, length, delta_t, snapshots, control):
+    """The body of the physics process started by Pendulums.StartWorker().
+    It steps its own copy of the model with the paced loop in a thread
+    and publishes to the shared snapshots, while this thread waits for
+    control messages:
+        ('start',), ('stop',), ('quit',),
+        ('pacing', rt_factor, slice_time, max_lag),
+        ('integrator', integrator, sub_steps, tolerance).
+    """
+    p = Pendulums(pends, length, delta_t, display=False)
+    p.snapshots = snapshots
+    p.PublishState()
+    p.SetPacing(True)
+    while True:
+        msg = control.get()
+        if msg[0] in ['stop', 'quit', 'pacing'] and p.thread:
+            p.paced = False
+            p.thread.join()
+            p.thread = None
+        if msg[0] == 'quit':
+            return
+        if msg[0] == 'pacing':
+            p.SetPacing(True, *msg[1:])
+        elif msg[0] == 'integrator':
+            p.SetIntegrator(*msg[1:])
+        if msg[0] in ['start', 'pacing'] and not p.thread:
+            p.paced = True
+            p.thread = threading.Thread(group=None,
+                                        target=p.RunPacedPendulums)
+            p.thread.daemon = True
+            p.thread.start()
+
+
 class Pendulums(object):
     """Manages a collection of pendulums.  This runs two threads: one
     thread setps through the physical model in small time steps.  The
-    other updates the display at longer intervals.
+    other updates the display at longer intervals.  Optionally, the
+    physics runs in a separate process instead (see StartWorker()).
     """
 
     def __init__(self, pends, length=0.2, delta_t=0.0003,
-                 update_interval=0.005):
+                 update_interval=0.005, renderer='items', display=True,
+                 use_process=False):
+        self.specs = pends
+        self.length = length
+        self.use_process = use_process
+        self.worker = None
+        self.control = None
         self.pends = []
         for mass, angle, color in pends:
             self.pends.append(Pend(mass, length, angle, color, delta_t))
         self.del_t = delta_t
         self.update = update_interval
-        self.bob = Bob()
+        self.bob = None
+        if display:
+            self.bob = Bob(renderer=renderer)
         self.after_id = None
         self.thread = None
+        self.neighbours_only = True
+        self.order = list(range(len(self.pends)))
+        self.solver = collide.ChainSolver()
+        self.paced = False
+        self.rt_factor = 1.0
+        self.slice = 0.005
+        self.max_lag = 0.5
+        self.sim_time = 0.0
+        self.lag = 0.0
+        self.n_steps = 0
+        self.n_batches = 0
+        self.n_resyncs = 0
+        self.initial_energy = self.TotalEnergy()
+        self.snapshots = SnapshotBuffer(len(self.pends))
+        self.PublishState()
+
+    def PublishState(self):
+        self.snapshots.Publish([pend.angle for pend in self.pends],
+                               [pend.speed for pend in self.pends],
+                               self.n_steps)
+
+    def StartWorker(self):
+        """Run the physics in a separate process, which publishes its
+        state through a SharedSnapshotBuffer.  This process then only
+        draws.  The worker is always paced; see SetPacing()."""
+        if self.worker:
+            return
+        self.snapshots = SharedSnapshotBuffer(len(self.pends))
+        self.PublishState()
+        self.control = multiprocessing.Queue()
+        self.worker = multiprocessing.Process(
+            target=PendulumWorker, args=(self.specs, self.length, self.del_t,
+                                         self.snapshots, self.control))
+        self.worker.daemon = True
+        self.worker.start()
+        if self.pends and self.pends[0].integrator != 'euler':
+            pend = self.pends[0]
+            self.control.put(('integrator', pend.integrator, pend.sub_steps,
+                              pend.tolerance))
+        self.control.put(('pacing', self.rt_factor, self.slice,
+                          self.max_lag))
+        self.control.put(('start',))
+
+    def StopWorker(self):
+        if self.worker:
+            self.control.put(('quit',))
+            self.worker.join()
+            self.worker = None
+            self.control = None
+
+    def SetPacing(self, paced=True, rt_factor=1.0, slice_time=0.005,
+                  max_lag=0.5):
+        """Pace the physics thread against the wall clock in batches.
+        Every slice_time seconds it works out how many steps of del_t are
+        due to keep simulated time at rt_factor times wall-clock time, and
+        runs them back to back.  An rt_factor of 0 runs as fast as
+        possible.  If the simulation falls more than max_lag seconds of
+        simulated time behind, it gives up on catching up and starts
+        pacing afresh."""
+        self.paced = paced
+        self.rt_factor = rt_factor
+        self.slice = slice_time
+        self.max_lag = max_lag
+        if self.control:
+            self.control.put(('pacing', rt_factor, slice_time, max_lag))
+
+    def PacingStats(self):
+        """Return the simulated time, the current lag behind the paced
+        target in seconds of simulated time, counts of steps, batches and
+        resyncs, and the total energy with its drift since the start."""
+        energy = self.TotalEnergy()
+        return {'sim_time': self.sim_time, 'lag': self.lag,
+                'steps': self.n_steps, 'batches': self.n_batches,
+                'resyncs': self.n_resyncs, 'energy': energy,
+                'energy_drift': energy - self.initial_energy}
+
+    def SetIntegrator(self, integrator='euler', sub_steps=1, tolerance=None):
+        """Set the integrator of every pendulum; see Pend.SetIntegrator()."""
+        for pend in self.pends:
+            pend.SetIntegrator(integrator, sub_steps, tolerance)
+        if self.control:
+            self.control.put(('integrator', integrator, sub_steps, tolerance))
+
+    def TotalEnergy(self):
+        """The total energy of the system.  Collisions conserve it, so any
+        change over time is integration error."""
+        return sum([pend.Energy() for pend in self.pends])
+
+    def StepPendulums(self, n_steps):
+        """Run the model for n_steps steps of del_t."""
+        if tracing.enabled:
+            tracing.Begin('Pendulums.StepPendulums')
+        for step in range(n_steps):
+            for pend in self.pends:
+                pend.Step()
+            self.CollidePendulums()
+        self.sim_time += n_steps * self.del_t
+        self.n_steps += n_steps
+        self.PublishState()
+        if tracing.enabled:
+            tracing.End('Pendulums.StepPendulums', {'steps': n_steps})
+
+    def CandidatePairs(self):
+        """Return the pairs of pendulum indices that could collide in the
+        next step.  The bobs all travel the same circle, so each can only
+        hit its angular neighbours, paired as (behind, ahead) in track order
+        (see collide.RingPairs()); the order is kept from step to step,
+        where it rarely changes."""
+        n = len(self.pends)
+        if not self.neighbours_only:
+            return [(i, i2) for i in range(n - 1) for i2 in range(i + 1, n)]
+        if len(self.order) != n:
+            self.order = list(range(n))
+        pi2 = 2.0 * math.pi
+        angles = [pend.angle % pi2 for pend in self.pends]
+        self.order.sort(key=angles.__getitem__)
+        return collide.RingPairs(self.order, angles)
+
+    def CollidePendulums(self):
+        """Resolve the collisions in the next step chain by chain (see
+        collide.py).  The pendulums all have the same length, so their
+        speeds order them as their angular velocities do."""
+        if not self.neighbours_only:
+            self.CollidePairs()
+            return
+        pends = self.pends
+        pairs = self.CandidatePairs()
+        hits = [k for k in range(len(pairs))
+                if pends[pairs[k][0]].WillCollide(pends[pairs[k][1]])]
+        if not hits:
+            return
+        self.solver.Resolve(pairs, collide.AttributeList(pends, 'mass'),
+                            collide.AttributeList(pends, 'speed'),
+                            lambda i, i2: pends[i].WillCollide(pends[i2]),
+                            hits)
+        metrics.Observe('pend.collision_passes', self.solver.n_sweeps, 1.0)
+        if self.solver.failed:
+            print 'Collision failure'
+            metrics.Count('pend.collision_failures')
+
+    def CollidePairs(self):
+        """Check every pair for a collision, in up to five passes.  Used
+        when neighbours_only is off."""
+        count = 0
+        total = 0
+        pairs = self.CandidatePairs()
+        while count < 5:
+            collisions = 0
+            for i, i2 in pairs:
+                did_collide = self.pends[i].Collide(self.pends[i2])
+                if did_collide:
+                    collisions += 1
+            total += collisions
+            count += 1
+            if count > 4:
+                print 'Collision failure'
+                metrics.Count('pend.collision_failures')
+            if not collisions:
+                break
+        if total:
+            metrics.Observe('pend.collision_passes', count, 1.0)
+
+    def RunPacedPendulums(self):
+        """Run the steps in paced batches until pacing is turned off.  A
+        change of the pacing settings starts the pacing afresh."""
+        settings = None
+        while self.paced:
+            time1 = time.time()
+            if settings != (self.rt_factor, self.slice, self.del_t):
+                settings = (self.rt_factor, self.slice, self.del_t)
+                batch = max(1, int(self.slice / self.del_t))
+                max_steps = 4 * max(batch, int(self.slice * self.rt_factor /
+                                               self.del_t))
+                start_wall = time1
+                start_sim = self.sim_time
+            if self.rt_factor > 0.0:
+                target = start_sim + ((time1 - start_wall) * self.rt_factor)
+                n_steps = int((target - self.sim_time) / self.del_t)
+                n_steps = max(0, min(n_steps, max_steps))
+            else:
+                target = self.sim_time
+                n_steps = batch
+            self.StepPendulums(n_steps)
+            self.n_batches += 1
+            self.lag = max(0.0, target - self.sim_time)
+            metrics.Observe('pend.lag', self.lag)
+            if self.lag > self.max_lag:
+                start_wall = time.time()
+                start_sim = self.sim_time
+                self.n_resyncs += 1
+                metrics.Count('pend.resyncs')
+            if self.rt_factor > 0.0:
+                tsleep = self.slice - (time.time() - time1)
+                if tsleep > 0.0:
+                    time.sleep(tsleep)
 
     def RunPendulums(self):
+        """Step the model for as long as the program runs: in paced
+        batches while pacing is on (see SetPacing()), otherwise one step
+        at a time with a sleep of del_t between them.  Pacing can be
+        turned on or off at any time."""
+        start_wall = None
         while True:
+            if self.paced:
+                self.RunPacedPendulums()
+                start_wall = None
+                continue
             time1 = time.time()
-            for pend in self.pends:
-                pend.Step()
-            count = 0
-            while count < 5:
-                collisions = 0
-                for i in range(len(self.pends) - 1):
-                    for i2 in range(i + 1, len(self.pends)):
-                        did_collide = self.pends[i].Collide(self.pends[i2])
-                        if did_collide:
-                            collisions += 1
-                count += 1
-                if count > 4:
-                    print 'Collision failure'
-                if not collisions:
-                    break
+            if start_wall is None:
+                start_wall = time1
+                start_sim = self.sim_time
+            self.StepPendulums(1)
             time2 = time.time()
+            if not (self.n_steps % 64):
+                self.lag = max(0.0, (time2 - start_wall) -
+                               (self.sim_time - start_sim))
+                metrics.Observe('pend.lag', self.lag)
             tsleep = self.del_t - (time2 - time1)
             if tsleep > 0.0:
                 time.sleep(tsleep)
 
     def Run(self):
-        if not self.thread:
+        if self.use_process:
+            self.StartWorker()
+        elif not self.thread:
             self.thread = threading.Thread(group=None, target=self.RunPendulums)
             self.thread.daemon = True
             self.thread.start()
         if self.after_id:
             self.bob.root.after_cancel(self.after_id)
             self.after_id = None
-        for pend in self.pends:
-            self.bob.DrawPend(pend, pend.angle, pend.mass, pend.length,
-                              pend.color)
+        snapshot = self.snapshots.Latest()
+        if snapshot:
+            angles = snapshot[0]
+            if self.worker:
+                # Mirror the worker's state, for TotalEnergy() and
+                # PacingStats().
+                for pend, angle, speed in zip(self.pends, angles,
+                                              snapshot[1]):
+                    pend.angle, pend.speed = angle, speed
+                self.n_steps = self.snapshots.steps
+                self.sim_time = self.n_steps * self.del_t
+            for i in range(len(self.pends)):
+                pend = self.pends[i]
+                self.bob.DrawPend(pend, angles[i], pend.mass, pend.length,
+                                  pend.color)
+            self.bob.Render()
         self.after_id = self.bob.root.after(int(self.update * 1000),
                                             self.Run)
 
@@ -223,19 +679,79 @@ def DecodePendulums(specs):
     return ret
 
 
+def DecodeIntegrator(spec):
+    """Decode integrator[,step[,sub_steps[,tolerance]]] into a list of
+    the four, with the defaults of Pendulums for those left out, or
+    return None, with a message, if spec is not valid."""
+    bits = spec.split(',')
+    ret = ['euler', 0.0003, 1, None]
+    if len(bits) > len(ret):
+        sys.stderr.write('Ill-formed integrator: %s\n' % (spec))
+        return None
+    try:
+        for i, convert in enumerate([str, float, int, float][:len(bits)]):
+            ret[i] = convert(bits[i])
+    except ValueError:
+        sys.stderr.write('Bad value in integrator: %s\n' % (spec))
+        return None
+    if ret[0] not in ['euler', 'verlet', 'rk4']:
+        sys.stderr.write('Unknown integrator (%s)\n' % (ret[0]))
+        return None
+    if ret[1] <= 0.0 or ret[2] < 1:
+        sys.stderr.write('The step and sub_steps must be positive: %s\n' %
+                         (spec))
+        return None
+    return ret
+
+
 def main(args):
+    renderer = 'items'
+    use_process = False
+    paced = True
+    trace_name = None
+    integrator = DecodeIntegrator('euler')
+    while len(args) > 1 and args[1] in ['-r', '-p', '-u', '-m', '-T', '-i']:
+        if args[1] == '-r':
+            renderer = 'raster'
+        elif args[1] == '-p':
+            use_process = True
+        elif args[1] == '-u':
+            paced = False
+        elif len(args) > 2:
+            if args[1] == '-m':
+                metrics.StartLog(args[2])
+            elif args[1] == '-i':
+                integrator = DecodeIntegrator(args[2])
+                if not integrator:
+                    sys.exit(-1)
+            else:
+                trace_name = args[2]
+                tracing.Enable()
+            args = args[:1] + args[2:]
+        args = args[:1] + args[2:]
     if len(args) > 1:
         pends = DecodePendulums(args[1:])
     else:
         pends = [[0.1, 0.0, '#00ff00'], [0.1, 270.01, 'blue'],
                  [0.1, 180.0, 'red'], ]
     if not pends:
-        sys.stderr.write('Usage: %s mass1,angle1,color1 '
-                         'mass2,angle2,color2 ...\n' % (args[0]))
+        sys.stderr.write('Usage: %s [-r] [-p] [-u] [-m log] [-T trace] '
+                         '[-i integrator[,step[,sub_steps[,tolerance]]]] '
+                         'mass1,angle1,color1 mass2,angle2,color2 ...\n' %
+                         (args[0]))
         sys.exit(-1)
-    p = Pendulums(pends, length=0.4)
+    p = Pendulums(pends, length=0.4, delta_t=integrator[1],
+                  renderer=renderer, use_process=use_process)
+    p.SetIntegrator(integrator[0], integrator[2], integrator[3])
+    p.SetPacing(paced)
     p.Run()
     tk.mainloop()
+    stats = p.PacingStats()
+    print 'Energy %g J, drift %g J over %.1f s with %s at %g s' % (
+        stats['energy'], stats['energy_drift'], stats['sim_time'],
+        integrator[0], integrator[1])
+    if trace_name:
+        tracing.Export(trace_name)
 
 
 if __name__ == '__main__':
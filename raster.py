@@ -0,0 +1,217 @@
+#!/usr/bin/python
+#
+"""Draws discs and lines into a numpy RGB buffer and displays the buffer
+on a Tk canvas through a single PhotoImage.  This is an alternative to
+one canvas item per shape when there are very many shapes."""
+#
+#
+# Copyright 2017 David Talkin.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+__author__ = 'dtalkin@gmail.com (David Talkin)'
+
+import collections
+import Tkinter as tk
+import numpy as np
+
+
+def PPMData(rgb):
+    """Format an RGB array as binary PPM image data that Tk will accept.
+    Each byte becomes one character, which Tcl turns back into a byte."""
+    height, width = rgb.shape[:2]
+    header = 'P6 %d %d 255 ' % (width, height)
+    return header + rgb.tostring().decode('latin-1')
+
+
+class Raster(object):
+    """Keeps a list of shapes, keyed by the caller, and renders them over a
+    plain background.  Only the tiles covered by shapes that were added,
+    moved, recolored or removed since the last frame are redrawn and sent
+    to Tk, unless so much changed that a full redraw is cheaper."""
+    tile = 32
+    max_colors = 64
+
+    def __init__(self, canvas, width, height, background='black'):
+        self.canvas = canvas
+        self.width = int(width)
+        self.height = int(height)
+        self.colors = collections.OrderedDict()
+        self.background = self.ToRGB(background)
+        self.buffer = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        self.shapes = collections.OrderedDict()
+        self.masks = {}
+        self.n_tiles_y = (self.height + Raster.tile - 1) // Raster.tile
+        self.n_tiles_x = (self.width + Raster.tile - 1) // Raster.tile
+        self.dirty = np.zeros((self.n_tiles_y, self.n_tiles_x), dtype=bool)
+        self.full = True
+        self.n_frames = 0
+        self.n_blits = 0
+        self.image = tk.PhotoImage(width=self.width, height=self.height)
+        self.item = canvas.create_image(0, 0, image=self.image, anchor=tk.NW)
+
+    def ToRGB(self, color):
+        """Convert a Tk color name or #rrggbb string to an (r, g, b) tuple.
+        Tuples are passed through.  #rrggbb strings are parsed here;
+        anything else is looked up by Tk, and the last max_colors of those
+        are remembered."""
+        if isinstance(color, tuple):
+            return color
+        if (len(color) == 7) and (color[0] == '#'):
+            try:
+                return (int(color[1:3], 16), int(color[3:5], 16),
+                        int(color[5:7], 16))
+            except ValueError:
+                pass
+        rgb = self.colors.get(color)
+        if rgb is None:
+            if len(self.colors) >= Raster.max_colors:
+                self.colors.popitem(last=False)
+            rgb = self.canvas.winfo_rgb(color)
+            rgb = (rgb[0] >> 8, rgb[1] >> 8, rgb[2] >> 8)
+            self.colors[color] = rgb
+        return rgb
+
+    def DiscMask(self, radius):
+        if radius not in self.masks:
+            span = np.arange(-radius, radius + 1)
+            self.masks[radius] = ((span[np.newaxis, :] ** 2) +
+                                  (span[:, np.newaxis] ** 2)) <= (radius ** 2)
+        return self.masks[radius]
+
+    def MarkDirty(self, bbox):
+        x0 = max(0, bbox[0]) // Raster.tile
+        y0 = max(0, bbox[1]) // Raster.tile
+        x1 = (min(self.width, bbox[2]) + Raster.tile - 1) // Raster.tile
+        y1 = (min(self.height, bbox[3]) + Raster.tile - 1) // Raster.tile
+        if (x1 > x0) and (y1 > y0):
+            self.dirty[y0:y1, x0:x1] = True
+
+    def SetShape(self, key, shape):
+        old = self.shapes.get(key)
+        if old == shape:
+            return
+        if old:
+            self.MarkDirty(old[2])
+        self.MarkDirty(shape[2])
+        self.shapes[key] = shape
+
+    def Disc(self, key, x, y, radius, color):
+        """Place a filled disc of the given radius centered at x, y."""
+        radius = int(radius)
+        cx = int(round(x))
+        cy = int(round(y))
+        bbox = (cx - radius, cy - radius, cx + radius + 1, cy + radius + 1)
+        self.SetShape(key, ('disc', (cx, cy, radius), bbox,
+                            self.ToRGB(color)))
+
+    def Line(self, key, x1, y1, x2, y2, color):
+        """Place a one pixel wide line from x1, y1 to x2, y2."""
+        x1, y1 = int(round(x1)), int(round(y1))
+        x2, y2 = int(round(x2)), int(round(y2))
+        bbox = (min(x1, x2), min(y1, y2), max(x1, x2) + 1, max(y1, y2) + 1)
+        self.SetShape(key, ('line', (x1, y1, x2, y2), bbox,
+                            self.ToRGB(color)))
+
+    def Remove(self, key):
+        if key in self.shapes:
+            self.MarkDirty(self.shapes.pop(key)[2])
+
+    def Clear(self):
+        self.shapes.clear()
+        self.full = True
+
+    def SetBackground(self, color):
+        rgb = self.ToRGB(color)
+        if rgb != self.background:
+            self.background = rgb
+            self.full = True
+
+    def DrawShape(self, shape, clip):
+        """Draw shape into the buffer, limited to the rectangle clip."""
+        kind, params, bbox, rgb = shape
+        x0 = max(bbox[0], clip[0])
+        y0 = max(bbox[1], clip[1])
+        x1 = min(bbox[2], clip[2])
+        y1 = min(bbox[3], clip[3])
+        if (x1 <= x0) or (y1 <= y0):
+            return
+        if kind == 'disc':
+            mask = self.DiscMask(params[2])
+            sub = mask[y0 - bbox[1]:y1 - bbox[1], x0 - bbox[0]:x1 - bbox[0]]
+            self.buffer[y0:y1, x0:x1][sub] = rgb
+            return
+        lx1, ly1, lx2, ly2 = params
+        n = max(abs(lx2 - lx1), abs(ly2 - ly1)) + 1
+        xs = np.rint(np.linspace(lx1, lx2, n)).astype(np.int64)
+        ys = np.rint(np.linspace(ly1, ly2, n)).astype(np.int64)
+        keep = (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+        self.buffer[ys[keep], xs[keep]] = rgb
+
+    def Blit(self, x0, y0, x1, y1):
+        data = PPMData(self.buffer[y0:y1, x0:x1])
+        self.image.tk.call(self.image.name, 'put', data, '-format', 'ppm',
+                           '-to', x0, y0)
+        self.n_blits += 1
+
+    def DirtyRects(self):
+        """Merge the dirty tiles of each tile row into runs, and return
+        them as pixel rectangles."""
+        rects = []
+        tile = Raster.tile
+        for ty in range(self.n_tiles_y):
+            row = self.dirty[ty]
+            tx = 0
+            while tx < self.n_tiles_x:
+                if not row[tx]:
+                    tx += 1
+                    continue
+                start = tx
+                while (tx < self.n_tiles_x) and row[tx]:
+                    tx += 1
+                rects.append((start * tile, ty * tile,
+                              min(self.width, tx * tile),
+                              min(self.height, (ty + 1) * tile)))
+        return rects
+
+    def Render(self):
+        """Bring the displayed image up to date with the shapes."""
+        self.n_frames += 1
+        if (not self.full) and (self.dirty.mean() > 0.5):
+            self.full = True
+        if self.full:
+            self.buffer[:, :] = self.background
+            clip = (0, 0, self.width, self.height)
+            for shape in self.shapes.values():
+                self.DrawShape(shape, clip)
+            self.Blit(0, 0, self.width, self.height)
+            self.full = False
+            self.dirty[:, :] = False
+            return
+        if not self.dirty.any():
+            return
+        shapes = list(self.shapes.values())
+        if shapes:
+            bboxes = np.array([s[2] for s in shapes])
+        for rect in self.DirtyRects():
+            x0, y0, x1, y1 = rect
+            self.buffer[y0:y1, x0:x1] = self.background
+            if shapes:
+                hits = np.nonzero((bboxes[:, 0] < x1) & (bboxes[:, 2] > x0) &
+                                  (bboxes[:, 1] < y1) &
+                                  (bboxes[:, 3] > y0))[0]
+                for i in hits:
+                    self.DrawShape(shapes[i], rect)
+            self.Blit(x0, y0, x1, y1)
+        self.dirty[:, :] = False
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+#
+"""Audio sinks: the places a Music object's samples can go.  Every sink
+pulls mono int16 blocks from the same callback, which has the PyAudio
+stream_callback signature, so the synthesis pipeline is the same whether
+the samples end up at the sound card, in a WAV file, on stdout or
+nowhere."""
+#
+#
+# Copyright 2017 David Talkin.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+__author__ = 'dtalkin@gmail.com (David Talkin)'
+
+import sys
+import time
+import threading
+import wave
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+# Callback return flags and status bits.  These are PyAudio's values, so
+# that callbacks can be handed to PyAudio unchanged.
+if pyaudio:
+    CONTINUE = pyaudio.paContinue
+    COMPLETE = pyaudio.paComplete
+    OUTPUT_UNDERFLOW = pyaudio.paOutputUnderflow
+else:
+    CONTINUE = 0
+    COMPLETE = 1
+    OUTPUT_UNDERFLOW = 4
+
+
+class AudioSink(object):
+    """The interface to an output for mono int16 audio.  Open() prepares
+    the sink to call callback(in_data, n_frames, time_info, status) for
+    each block of n_frames samples; Start() begins the calls, which
+    continue until the callback returns COMPLETE or Close() is called."""
+
+    def Open(self, callback, sample_rate, n_frames):
+        pass
+
+    def Start(self):
+        pass
+
+    def Close(self):
+        pass
+
+
+class PyAudioSink(AudioSink):
+    """Plays through PortAudio.  The PyAudio instance is created on first
+    use unless one is supplied."""
+
+    def __init__(self, audio=None):
+        self.audio = audio
+        self.stream = None
+
+    def Open(self, callback, sample_rate, n_frames):
+        self.Close()
+        if not self.audio:
+            self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(format=pyaudio.paInt16, start=False,
+                                      channels=1, frames_per_buffer=n_frames,
+                                      rate=int(sample_rate), output=True,
+                                      stream_callback=callback)
+
+    def Start(self):
+        if self.stream:
+            self.stream.start_stream()
+
+    def Close(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+
+class ThreadedSink(AudioSink):
+    """Calls the callback from a thread of its own, as PortAudio would,
+    and passes each block to Consume().  The blocks are paced at rate
+    times real time; a rate of 0 runs as fast as the callback allows.
+    When a paced block is late by more than a block, the next call
+    reports OUTPUT_UNDERFLOW in its status, as PortAudio does.  The
+    pacing starts afresh with each Start(); n_blocks, n_samps and
+    n_underflows count over the life of the sink."""
+
+    def __init__(self, rate=1.0):
+        self.rate = rate
+        self.callback = None
+        self.fs = 0.0
+        self.n_frames = 0
+        self.thread = None
+        self.running = False
+        self.n_blocks = 0
+        self.n_samps = 0
+        self.n_underflows = 0
+
+    def Open(self, callback, sample_rate, n_frames):
+        self.Close()
+        self.callback = callback
+        self.fs = float(sample_rate)
+        self.n_frames = n_frames
+
+    def Start(self):
+        if self.thread or not self.callback:
+            return
+        self.running = True
+        self.thread = threading.Thread(group=None, target=self.Run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Close(self):
+        self.running = False
+        if self.thread:
+            if self.thread is not threading.current_thread():
+                self.thread.join()
+            self.thread = None
+        self.callback = None
+
+    def Consume(self, data):
+        pass
+
+    def Run(self):
+        block_time = self.n_frames / self.fs
+        t_start = time.time()
+        n_run = 0
+        status = 0
+        while self.running:
+            # The block is consumed as soon as it is made, so it is output
+            # when it is due, or at once when unpaced.
+            t_now = time.time() - t_start
+            if self.rate > 0:
+                t_out = n_run * block_time / self.rate
+            else:
+                t_out = t_now
+            time_info = {'input_buffer_adc_time': 0.0,
+                         'current_time': t_now,
+                         'output_buffer_dac_time': t_out}
+            data, flag = self.callback(None, self.n_frames, time_info, status)
+            self.Consume(data)
+            n_run += 1
+            self.n_blocks += 1
+            self.n_samps += len(data) // 2
+            if flag == COMPLETE:
+                break
+            status = 0
+            if self.rate > 0:
+                due = t_start + (n_run * block_time / self.rate)
+                lag = time.time() - due
+                if lag > block_time / self.rate:
+                    status = OUTPUT_UNDERFLOW
+                    self.n_underflows += 1
+                elif lag < 0:
+                    time.sleep(-lag)
+        self.running = False
+
+
+class NullSink(ThreadedSink):
+    """Discards the samples, but still pulls them at the simulated rate.
+    Useful for benchmarking and on machines without an audio device."""
+    pass
+
+
+class WavSink(ThreadedSink):
+    """Writes the samples to a mono 16-bit WAV file, one block at a time.
+    The header is completed when the sink is closed."""
+
+    def __init__(self, file_name, rate=1.0):
+        ThreadedSink.__init__(self, rate)
+        self.file_name = file_name
+        self.wav = None
+
+    def Open(self, callback, sample_rate, n_frames):
+        ThreadedSink.Open(self, callback, sample_rate, n_frames)
+        self.wav = wave.open(self.file_name, 'wb')
+        self.wav.setnchannels(1)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(int(sample_rate))
+
+    def Consume(self, data):
+        self.wav.writeframes(bytes(data))
+
+    def Close(self):
+        ThreadedSink.Close(self)
+        if self.wav:
+            self.wav.close()
+            self.wav = None
+
+
+class StdoutSink(ThreadedSink):
+    """Writes raw native-endian int16 PCM to standard output, e.g. for
+    piping to 'aplay -f S16_LE -c 1 -r 22050'.  While the sink is open,
+    anything else the program prints is sent to standard error instead,
+    so that it does not end up in the audio."""
+
+    def __init__(self, rate=1.0):
+        ThreadedSink.__init__(self, rate)
+        self.out = None
+
+    def Open(self, callback, sample_rate, n_frames):
+        ThreadedSink.Open(self, callback, sample_rate, n_frames)
+        self.out = sys.stdout
+        sys.stdout = sys.stderr
+
+    def Close(self):
+        ThreadedSink.Close(self)
+        if self.out:
+            sys.stdout = self.out
+            self.out = None
+
+    def Consume(self, data):
+        try:
+            self.out.write(data)
+            self.out.flush()
+        except IOError:
+            self.running = False
+
+
+def MakeSink(spec, rate=1.0):
+    """Create a sink from a name: 'pyaudio', 'null', 'stdout' or
+    'wav:<file name>'.  Falls back to a NullSink, with a message, when
+    the name is unknown or pyaudio is not installed."""
+    if spec == 'pyaudio':
+        if pyaudio:
+            return PyAudioSink()
+        sys.stderr.write('pyaudio is not installed; using the null sink.\n')
+        return NullSink(rate)
+    if spec == 'null':
+        return NullSink(rate)
+    if spec == 'stdout':
+        return StdoutSink(rate)
+    if spec.startswith('wav:') and len(spec) > 4:
+        return WavSink(spec[4:], rate)
+    sys.stderr.write('Unknown audio sink %s; using the null sink.\n' % spec)
+    return NullSink(rate)
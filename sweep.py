@@ -0,0 +1,310 @@
+#!/usr/bin/python
+#
+"""Runs a sweep over ring configurations in a pool of worker processes,
+without a display or sound, and writes the statistics of each run to a
+tab-separated results file as the runs finish.  The file has a header
+line naming the columns and then one line per run; it is row-oriented,
+rather than stored column by column, so that each run can be appended
+as it finishes, and it loads into any spreadsheet or data frame.
+
+The sweep is specified by a JSON object giving, for each parameter, a
+list of the values to try; every combination is run.  The parameters
+are the Baller attributes n_range, size_range, v_range and starts, plus
+seed, mode ('list', 'array' or 'events', see bench.py) and duration
+(simulated seconds).  A range value may be a [low, high] pair, or a
+single number standing for [x, x].  Each value of starts is itself a
+list of starting angles, one per ball.  For example
+
+    {"n_range": [3, 5, 7], "v_range": [[-0.03, 0.03], [-0.01, 0.01]],
+     "seed": [1, 2, 3, 4]}
+
+runs 3, 5 and 7 balls at two speed ranges with four seeds each, and the
+defaults of Baller for the rest.
+
+If the results file already holds some runs of the same sweep, only the
+missing ones are run, so an interrupted sweep can be resumed by running
+the same command again."""
+#
+#
+# Copyright 2017 David Talkin.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+__author__ = 'dtalkin@gmail.com (David Talkin)'
+
+import os
+import sys
+import time
+import json
+import signal
+import itertools
+import traceback
+import multiprocessing
+import metrics
+import balls9
+
+# The sweep parameters, in the order of the results columns.
+PARAMS = ['n_range', 'size_range', 'v_range', 'starts', 'seed', 'mode',
+          'duration']
+RANGES = ['n_range', 'size_range', 'v_range']
+MODES = ['list', 'array', 'events']
+STATS = ['n_balls', 'tonic', 'steps', 'pings', 'ping_rate',
+         'collision_rate', 'energy', 'energy_drift', 'energy_share',
+         'energy_max_share', 'failures', 'wall_time']
+COLUMNS = PARAMS + STATS
+
+
+def Defaults():
+    """The value of each parameter when the sweep does not vary it."""
+    baller = balls9.Baller(None, None, 0.01)
+    return {'n_range': baller.n_range, 'size_range': baller.size_range,
+            'v_range': baller.v_range, 'starts': baller.starts, 'seed': 1,
+            'mode': 'list', 'duration': 60.0}
+
+
+def Format(value):
+    """Format a results field.  Lists are joined with commas, and floats
+    keep all their digits so that the parameters of a run read back the
+    same."""
+    if isinstance(value, (list, tuple)):
+        return ','.join([Format(x) for x in value])
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def Configs(spec):
+    """Return the parameter dicts of all runs of the sweep spec, or None,
+    with a message, if spec is not valid."""
+    defaults = Defaults()
+    unknown = [k for k in spec if k not in PARAMS]
+    if unknown:
+        sys.stderr.write('Unknown sweep parameters: %s\n' %
+                         ', '.join(sorted(unknown)))
+        return None
+    values = []
+    for name in PARAMS:
+        vals = spec.get(name, [defaults[name]])
+        if not isinstance(vals, list) or not vals:
+            sys.stderr.write('%s must be a non-empty list of values\n' % name)
+            return None
+        if name in RANGES:
+            vals = [v if isinstance(v, list) else [v, v] for v in vals]
+        if name == 'starts' and [v for v in vals
+                                 if not isinstance(v, list) or not v]:
+            sys.stderr.write('starts must be a non-empty list of lists of '
+                             'starting angles\n')
+            return None
+        if name == 'mode' and [v for v in vals if v not in MODES]:
+            sys.stderr.write('mode must be one of %s\n' % ', '.join(MODES))
+            return None
+        values.append(vals)
+    configs = []
+    for combo in itertools.product(*values):
+        params = dict(zip(PARAMS, combo))
+        if params['n_range'][1] > len(params['starts']):
+            sys.stderr.write('n_range %s needs more than the %d starts\n' %
+                             (Format(params['n_range']),
+                              len(params['starts'])))
+            return None
+        configs.append(params)
+    return configs
+
+
+def RunKey(params):
+    return tuple([Format(params[name]) for name in PARAMS])
+
+
+def RunConfig(params):
+    """Simulate one configuration as a HeadlessBaller would, and return
+    its row of results.  Collisions are counted as pairwise exchanges, so
+    a chain of three balls struck in one step counts at least two.
+    Energies are the balls' kinetic energies; the shares are of their
+    time averages."""
+    time1 = time.time()
+    baller = balls9.HeadlessBaller(seed=params['seed'])
+    baller.n_range = params['n_range']
+    baller.size_range = params['size_range']
+    baller.v_range = params['v_range']
+    baller.starts = params['starts']
+    ring = baller.orbit
+    ring.AddBalls(baller.CreateBalls())
+    if params['mode'] == 'array':
+        ring.SetArrayBacked(True)
+    elif params['mode'] == 'events':
+        ring.SetEventDriven(True)
+    failures = metrics.Get('balls.collision_failures') or 0
+    collisions = metrics.Get('balls.collisions') or 0
+    balls = ring.balls
+    n = len(balls)
+    n_steps = int(params['duration'] / baller.step_time)
+    energy = [0.5 * float(b.m * b.v * b.v) for b in balls]
+    energy0 = sum(energy)
+    totals = [0.0] * n
+    pings = [0] * n
+    last = 0
+    # The energies only change in collisions, so they are accumulated over
+    # the steps between them.
+    for step in range(n_steps):
+        hit_balls = ring.UpdatePositions()
+        if not hit_balls:
+            continue
+        for ball_ind in hit_balls:
+            pings[ball_ind] += 1
+        for i in range(n):
+            totals[i] += energy[i] * (step - last)
+        energy = [0.5 * float(b.m * b.v * b.v) for b in balls]
+        last = step
+    for i in range(n):
+        totals[i] += energy[i] * (n_steps - last)
+    sim_time = max(n_steps * baller.step_time, 1.0e-9)
+    share = [t / max(sum(totals), 1.0e-300) for t in totals]
+    row = dict(params)
+    row.update({'n_balls': n, 'tonic': baller.tonic, 'steps': n_steps,
+                'pings': pings, 'ping_rate': sum(pings) / sim_time,
+                'collision_rate': ((metrics.Get('balls.collisions') or 0) -
+                                   collisions) / sim_time,
+                'energy': energy0,
+                'energy_drift': (sum(energy) - energy0) /
+                max(energy0, 1.0e-300),
+                'energy_share': share, 'energy_max_share': max(share),
+                'failures': (metrics.Get('balls.collision_failures') or 0) -
+                failures,
+                'wall_time': time.time() - time1})
+    return row
+
+
+def RunSafely(params):
+    """Run RunConfig(params) in a worker.  Returns (row, None), or
+    (params, traceback text) if the run raised an exception, so that one
+    failed run does not stop the sweep."""
+    try:
+        return RunConfig(params), None
+    except Exception:
+        return params, traceback.format_exc()
+
+
+def ReadDone(file_name):
+    """Return the keys of the complete runs in results file file_name,
+    or None if it was not written by this program.  A line cut short by
+    an interrupted sweep is removed from the file."""
+    done = set([])
+    if not os.path.exists(file_name):
+        return done
+    with open(file_name) as results:
+        lines = results.readlines()
+    if not lines:
+        return done
+    if lines[0].rstrip('\n').split('\t') != COLUMNS:
+        sys.stderr.write('%s is not a sweep results file\n' % file_name)
+        return None
+    keep = lines[:1]
+    for line in lines[1:]:
+        fields = line.rstrip('\n').split('\t')
+        if line.endswith('\n') and (len(fields) == len(COLUMNS)):
+            done.add(tuple(fields[:len(PARAMS)]))
+            keep.append(line)
+    if len(keep) < len(lines):
+        with open(file_name, 'w') as results:
+            results.writelines(keep)
+    return done
+
+
+def IgnoreInterrupts():
+    # Leave Ctrl-C to the parent, which stops the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def Sweep(spec, file_name, n_jobs=None):
+    """Run the runs of spec that are not yet in file_name, n_jobs at a
+    time (by default one per core), appending each row as it finishes.
+    A run that fails is reported, with its traceback, and left out of
+    the file, so that running the sweep again retries it.  Returns the
+    number of runs made, or None on error."""
+    configs = Configs(spec)
+    if configs is None:
+        return None
+    done = ReadDone(file_name)
+    if done is None:
+        return None
+    pending = [c for c in configs if RunKey(c) not in done]
+    sys.stderr.write('%d runs, %d already done\n' %
+                     (len(configs), len(configs) - len(pending)))
+    if not pending:
+        return 0
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    results = open(file_name, 'a')
+    pool = None
+    finished = False
+    n_runs = 0
+    n_failed = 0
+    try:
+        if not results.tell():
+            results.write('\t'.join(COLUMNS) + '\n')
+            results.flush()
+        pool = multiprocessing.Pool(n_jobs, IgnoreInterrupts)
+        rows = pool.imap_unordered(RunSafely, pending)
+        while n_runs + n_failed < len(pending):
+            # Wait with a timeout so that Ctrl-C gets through.
+            try:
+                row, error = rows.next(1.0)
+            except multiprocessing.TimeoutError:
+                continue
+            if error:
+                n_failed += 1
+                sys.stderr.write('\nRun %s failed:\n%s' %
+                                 (' '.join(RunKey(row)), error))
+                continue
+            results.write('\t'.join([Format(row[c]) for c in COLUMNS]) +
+                          '\n')
+            results.flush()
+            n_runs += 1
+            sys.stderr.write('%d/%d\r' % (n_runs, len(pending)))
+        sys.stderr.write('\n')
+        if n_failed:
+            sys.stderr.write('%d runs failed; run again to retry them.\n' %
+                             n_failed)
+        finished = True
+    except KeyboardInterrupt:
+        sys.stderr.write('\nInterrupted after %d runs; run again to '
+                         'resume.\n' % n_runs)
+    finally:
+        if pool:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+        results.close()
+    return n_runs
+
+
+def main(args):
+    args = args[:]
+    n_jobs = None
+    while len(args) > 2 and args[1] == '-j':
+        n_jobs = int(args[2])
+        del args[1:3]
+    if len(args) != 3:
+        sys.stderr.write('Usage: %s [-j <processes>] <sweep json> '
+                         '<results file>\n' % (args[0]))
+        return 2
+    with open(args[1]) as spec_file:
+        spec = json.load(spec_file)
+    if Sweep(spec, args[2], n_jobs) is None:
+        return 2
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,301 @@
+#!/usr/bin/python
+#
+"""Tests of the chain collision solver (collide.py) and of its use by the
+balls (balls9.py).  Run with python -m unittest test_collide."""
+#
+#
+# Copyright 2017 David Talkin.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+__author__ = 'dtalkin@gmail.com (David Talkin)'
+
+import math
+import random
+import unittest
+import collide
+import balls9
+
+
+def Chain(masses, velocities, spacing=0.001):
+    """Lay out bodies in a row along the track, spacing radians apart, and
+    return their angles, pairs, contact function and initial hits."""
+    angles = [1.0 + (i * spacing) for i in range(len(masses))]
+    order = list(range(len(masses)))
+    pairs = collide.RingPairs(order, angles)
+    def Contact(i, i2):
+        return collide.WillMeet(angles[i], velocities[i], angles[i2],
+                                velocities[i2])
+    hits = [k for k in range(len(pairs)) if Contact(*pairs[k])]
+    return angles, pairs, Contact, hits
+
+
+def Momentum(masses, velocities):
+    return sum([m * v for m, v in zip(masses, velocities)])
+
+
+def Energy(masses, velocities):
+    return sum([0.5 * m * v * v for m, v in zip(masses, velocities)])
+
+
+class ChainSolverTest(unittest.TestCase):
+
+    def testNewtonsCradle(self):
+        velocities = [0.01, 0.0, 0.0, 0.0, 0.0]
+        masses = [1.0] * 5
+        angles, pairs, contact, hits = Chain(masses, velocities)
+        solver = collide.ChainSolver()
+        before = solver.Resolve(pairs, masses, velocities, contact, hits)
+        self.assertFalse(solver.failed)
+        for v in velocities[:-1]:
+            self.assertAlmostEqual(v, 0.0, places=12)
+        self.assertAlmostEqual(velocities[-1], 0.01, places=12)
+        self.assertEqual(sorted(before), list(range(5)))
+
+    def testConservation(self):
+        rand = random.Random(3)
+        for trial in range(50):
+            n = rand.randint(3, 12)
+            masses = [rand.uniform(1.0, 40.0) for i in range(n)]
+            velocities = [rand.uniform(-0.02, 0.02) for i in range(n)]
+            p0 = Momentum(masses, velocities)
+            e0 = Energy(masses, velocities)
+            angles, pairs, contact, hits = Chain(masses, velocities)
+            solver = collide.ChainSolver()
+            solver.Resolve(pairs, masses, velocities, contact, hits)
+            self.assertFalse(solver.failed)
+            self.assertEqual(solver.n_conservation_errors, 0)
+            self.assertAlmostEqual(Momentum(masses, velocities), p0,
+                                   delta=1.0e-12 * sum(masses))
+            self.assertAlmostEqual(Energy(masses, velocities), e0,
+                                   delta=1.0e-12 * e0)
+
+    def testNoPairLeftApproaching(self):
+        rand = random.Random(5)
+        for trial in range(50):
+            n = rand.randint(2, 12)
+            masses = [rand.uniform(1.0, 40.0) for i in range(n)]
+            velocities = [rand.uniform(-0.02, 0.02) for i in range(n)]
+            angles, pairs, contact, hits = Chain(masses, velocities)
+            collide.ChainSolver().Resolve(pairs, masses, velocities, contact,
+                                          hits)
+            for behind, ahead in pairs:
+                self.assertFalse(contact(behind, ahead) and
+                                 velocities[behind] > velocities[ahead] +
+                                 1.0e-12)
+
+    def testSharedBudget(self):
+        # Ten separate cradles, resolved together, sweep in step with one
+        # another rather than one after another.
+        masses = [1.0, 3.0, 9.0, 27.0, 81.0, 1.0] * 10
+        velocities = [0.0, 0.0, 0.0, 0.0, -0.01, 0.0] * 10
+        angles = []
+        for c in range(10):
+            angles.extend([0.1 + (0.5 * c) + (0.001 * i) for i in range(5)])
+            angles.append(0.1 + (0.5 * c) + 0.3)
+        order = list(range(len(masses)))
+        pairs = collide.RingPairs(order, angles)
+        def Contact(i, i2):
+            return collide.WillMeet(angles[i], velocities[i], angles[i2],
+                                    velocities[i2])
+        hits = [k for k in range(len(pairs)) if Contact(*pairs[k])]
+        self.assertEqual(len(hits), 10)
+        one = collide.ChainSolver()
+        one_velocities = velocities[:6]
+        one.Resolve(pairs[:5], masses[:6], one_velocities, Contact, hits[:1])
+        self.assertFalse(one.failed)
+        solver = collide.ChainSolver()
+        solver.Resolve(pairs, masses, list(velocities), Contact, hits)
+        self.assertFalse(solver.failed)
+        self.assertEqual(solver.n_sweeps, one.n_sweeps)
+        self.assertTrue(solver.n_sweeps > 1)
+
+        limited = collide.ChainSolver(max_sweeps=1)
+        limited.Resolve(pairs, masses, list(velocities), Contact, hits)
+        self.assertTrue(limited.failed)
+        self.assertEqual(limited.n_sweeps, 1)
+        self.assertEqual(limited.n_failures, 1)
+        limited.Resolve(pairs, masses, list(velocities), Contact, [])
+        self.assertFalse(limited.failed)
+        self.assertEqual(limited.n_failures, 1)
+
+
+def MakeRing(specs):
+    """A Ring of balls from (size, angle, velocity) specs."""
+    balls = []
+    for size, angle, velocity in specs:
+        ball = balls9.Ball(None, size, 'red', angle, velocity)
+        ball.ball_ind = len(balls)
+        balls.append(ball)
+    return balls9.Ring(balls)
+
+
+def CyclicOrder(ring):
+    """The indices of the balls in track order, starting from ball 0."""
+    pi2 = 2.0 * math.pi
+    order = sorted(range(len(ring.balls)),
+                   key=lambda b: ring.balls[b].angle % pi2)
+    start = order.index(0)
+    return order[start:] + order[:start]
+
+
+class RingTest(unittest.TestCase):
+
+    def testNoPassThrough(self):
+        rand = random.Random(7)
+        n = 12
+        specs = [(rand.uniform(5.0, 40.0), (2.0 * math.pi * i) / n,
+                  rand.uniform(-0.03, 0.03)) for i in range(n)]
+        ring = MakeRing(specs)
+        order = CyclicOrder(ring)
+        p0 = Momentum([b.m for b in ring.balls], [b.v for b in ring.balls])
+        n_collided = 0
+        for step in range(3000):
+            n_collided += len(ring.UpdatePositions())
+            self.assertEqual(CyclicOrder(ring), order)
+        self.assertTrue(n_collided > 0)
+        self.assertAlmostEqual(Momentum([b.m for b in ring.balls],
+                                        [b.v for b in ring.balls]), p0,
+                               delta=1.0e-9 * abs(p0))
+
+    def PileUp(self, sizes):
+        """Resolve three touching balls, the first moving into the others,
+        both chain by chain and with ResolvePairs(), and return the two."""
+        specs = [(sizes[0], 1.0, 0.02), (sizes[1], 1.0001, 0.0),
+                 (sizes[2], 1.0002, -0.001)]
+        chain = MakeRing(specs)
+        pairs = MakeRing(specs)
+        pairs.neighbours_only = False
+        self.assertEqual(chain.ResolveCollisions(), set([0, 1, 2]))
+        self.assertEqual(pairs.ResolveCollisions(), set([0, 1, 2]))
+        return chain, pairs
+
+    def testPileUpMatchesPairs(self):
+        for sizes in [(10.0, 10.0, 10.0), (10.0, 40.0, 5.0),
+                      (5.0, 10.0, 20.0)]:
+            chain, pairs = self.PileUp(sizes)
+            for ball, other in zip(chain.balls, pairs.balls):
+                self.assertAlmostEqual(ball.v, other.v, places=12)
+
+    def testPileUpConserves(self):
+        # A heavy first ball is still faster than the third after the
+        # first impulse, and ResolvePairs() then strikes those two
+        # directly, through the second, so the outcomes differ; both must
+        # still conserve and leave no pair approaching.
+        chain, pairs = self.PileUp((30.0, 10.0, 20.0))
+        masses = [b.m for b in chain.balls]
+        p0 = Momentum(masses, [0.02, 0.0, -0.001])
+        e0 = Energy(masses, [0.02, 0.0, -0.001])
+        for ring in [chain, pairs]:
+            velocities = [b.v for b in ring.balls]
+            self.assertAlmostEqual(Momentum(masses, velocities), p0,
+                                   places=12)
+            self.assertAlmostEqual(Energy(masses, velocities), e0, places=12)
+            self.assertTrue(velocities[0] <= velocities[1] <= velocities[2])
+
+    def testEventDrivenFastBalls(self):
+        # The balls move further in a step than the spacing between them,
+        # so stepping and then checking lets them pass through each other.
+        rand = random.Random(3)
+        n = 30
+        specs = [(rand.uniform(5.0, 40.0), (2.0 * math.pi * i) / n,
+                  rand.uniform(-0.3, 0.3)) for i in range(n)]
+        ring = MakeRing(specs)
+        ring.SetEventDriven(True)
+        order = CyclicOrder(ring)
+        masses = [b.m for b in ring.balls]
+        p0 = Momentum(masses, [b.v for b in ring.balls])
+        e0 = Energy(masses, [b.v for b in ring.balls])
+        n_collided = 0
+        for step in range(500):
+            n_collided += len(ring.UpdatePositions())
+            self.assertEqual(CyclicOrder(ring), order)
+        velocities = [b.v for b in ring.balls]
+        self.assertTrue(n_collided > 0)
+        self.assertAlmostEqual(Momentum(masses, velocities), p0,
+                               delta=1.0e-9 * sum([abs(m * s[2]) for m, s
+                                                   in zip(masses, specs)]))
+        self.assertAlmostEqual(Energy(masses, velocities), e0,
+                               delta=1.0e-9 * e0)
+
+    @unittest.skipIf(balls9.np is None, 'numpy is not available')
+    def testArrayMatchesList(self):
+        rand = random.Random(11)
+        n = 12
+        specs = [(rand.uniform(5.0, 40.0), (2.0 * math.pi * i) / n,
+                  rand.uniform(-0.03, 0.03)) for i in range(n)]
+        states = []
+        for array_backed in [False, True]:
+            # The color ranges are shared by all balls, so both rings start
+            # from the same ones.
+            balls9.Ball(None, 10.0, 'red', 0.0, 0.0).ResetRanges()
+            ring = MakeRing(specs)
+            ring.SetArrayBacked(array_backed)
+            for step in range(2000):
+                ring.UpdatePositions()
+            states.append([(b.angle, b.v, b.mom_n, b.e_n, b.e_gain_n)
+                           for b in ring.balls])
+        for ball, view in zip(states[0], states[1]):
+            self.assertAlmostEqual(ball[0], view[0], places=9)
+            self.assertAlmostEqual(ball[1], view[1], places=12)
+            self.assertEqual(ball[2:], view[2:])
+
+    @unittest.skipIf(balls9.np is None, 'numpy is not available')
+    def testBallViews(self):
+        ring = MakeRing([(10.0, 1.0, 0.02), (20.0, 1.01, -0.01)])
+        ring.SetArrayBacked(True)
+        first, second = ring.balls
+        self.assertTrue(isinstance(first, balls9.Ball))
+        self.assertEqual(first.m, 10.0)
+        first.v = 0.03
+        self.assertEqual(ring.store.v[0], 0.03)
+        # The Ball methods work on the views, through the store.
+        self.assertEqual(first.Collide(second), (0, 1))
+        v1, v2 = collide.Elastic(10.0, 20.0, 0.03, -0.01)
+        self.assertAlmostEqual(ring.store.v[0], v1, places=12)
+        self.assertAlmostEqual(ring.store.v[1], v2, places=12)
+        self.assertEqual(ring.store.old_e[0], 0.5 * 10.0 * 0.03 * 0.03)
+        self.assertEqual(first.MakeColor(),
+                         ('#%2x%2x%2x' % (ring.store.mom_n[0],
+                                          ring.store.e_n[0],
+                                          ring.store.e_gain_n[0])
+                          ).replace(' ', '0'))
+
+    def testStaleEventsSkipped(self):
+        # Ball 0 chases ball 1, which is struck first by ball 2, so the
+        # impact of 0 and 1 predicted at the start, at step 10, is stale.
+        ring = MakeRing([(10.0, 0.0, 0.1), (10.0, 1.0, 0.0),
+                         (10.0, 1.2, -0.1)])
+        scheduler = balls9.CollisionScheduler(ring.balls)
+        self.assertEqual(scheduler.Advance(3.0), set([1, 2]))
+        self.assertEqual(scheduler.n_events, 1)
+        stale = [e for e in scheduler.queue if e[1:3] == (0, 1) and
+                 e[4] != scheduler.counts[1]]
+        self.assertEqual(len(stale), 1)
+        self.assertAlmostEqual(stale[0][0], 10.0)
+        # The new prediction is at step 6: a gap of 0.8 closing at 0.2.
+        self.assertEqual(scheduler.Advance(4.0), set([0, 1]))
+        self.assertEqual(scheduler.n_events, 2)
+        self.assertAlmostEqual(ring.balls[0].v, -0.1)
+        self.assertAlmostEqual(ring.balls[1].v, 0.1)
+        # The stale event comes due, at the same time as ball 1 reaches
+        # ball 2 again, and is dropped; ball 0 keeps moving away.
+        self.assertEqual(scheduler.Advance(4.0), set([1, 2]))
+        self.assertEqual(scheduler.n_events, 3)
+        self.assertAlmostEqual(ring.balls[0].v, -0.1)
+        self.assertAlmostEqual(ring.balls[0].angle, 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
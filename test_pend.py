@@ -0,0 +1,172 @@
+#!/usr/bin/python
+#
+"""Tests of the pendulum model (pend.py).  Run with python -m unittest
+test_pend."""
+#
+#
+# Copyright 2017 David Talkin.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+__author__ = 'dtalkin@gmail.com (David Talkin)'
+
+import sys
+import time
+import threading
+import multiprocessing
+import unittest
+import pend
+
+
+def Writer(snapshots, n_pends, duration):
+    """Publish snapshot after snapshot for duration seconds, each with
+    every angle, speed and the step count equal to its number, so that
+    a mix of two is easy to spot."""
+    end = time.time() + duration
+    steps = 0
+    while time.time() < end:
+        steps += 1
+        values = [float(steps)] * n_pends
+        snapshots.Publish(values, values, steps)
+
+
+class InterruptedList(list):
+    """A list that calls hook, once, when it is first iterated over, as
+    when a reader copying it is preempted by the writer."""
+
+    def __iter__(self):
+        hook = getattr(self, 'hook', None)
+        if hook:
+            self.hook = None
+            hook()
+        return list.__iter__(self)
+
+
+class InterruptedArray(object):
+    """Wraps the shared array of a SharedSnapshotBuffer, and calls hook,
+    once, half way through the first copy of a slice of it."""
+
+    def __init__(self, data):
+        self.data = data
+        self.hook = None
+
+    def __getitem__(self, i):
+        if not (isinstance(i, slice) and self.hook):
+            return self.data[i]
+        hook = self.hook
+        self.hook = None
+        middle = (i.start + i.stop) // 2
+        first = self.data[i.start:middle]
+        hook()
+        return first + self.data[middle:i.stop]
+
+    def __setitem__(self, i, value):
+        self.data[i] = value
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def ReadWhile(self, snapshots, writer):
+        """Read snapshots until writer is done, checking that each comes
+        whole from one Publish(), and return the number read."""
+        n_read = 0
+        last = 0
+        while writer.is_alive() or n_read == 0:
+            snapshot = snapshots.Latest()
+            if not snapshot:
+                continue
+            angles, speeds = snapshot
+            steps = snapshots.steps
+            self.assertTrue(steps > last)
+            self.assertEqual(set(angles), set([float(steps)]))
+            self.assertEqual(set(speeds), set([float(steps)]))
+            last = steps
+            n_read += 1
+        writer.join()
+        return n_read
+
+    def testSnapshotBuffer(self):
+        n_pends = 500
+        snapshots = pend.SnapshotBuffer(n_pends, n_buffers=2)
+        writer = threading.Thread(target=Writer,
+                                  args=(snapshots, n_pends, 0.5))
+        # Switch threads as often as possible, so that reads overlap
+        # writes.
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            writer.start()
+            n_read = self.ReadWhile(snapshots, writer)
+        finally:
+            sys.setcheckinterval(interval)
+        stats = snapshots.Stats()
+        self.assertEqual(stats['read'], n_read)
+        self.assertEqual(stats['read'] + stats['skipped'],
+                         snapshots.read_seq)
+
+    def testSharedSnapshotBuffer(self):
+        # Long records in few slots, so that the writer process often
+        # rewrites the slot being copied.
+        n_pends = 20000
+        snapshots = pend.SharedSnapshotBuffer(n_pends, n_buffers=2)
+        writer = multiprocessing.Process(target=Writer,
+                                         args=(snapshots, n_pends, 1.0))
+        writer.start()
+        n_read = self.ReadWhile(snapshots, writer)
+        self.assertEqual(writer.exitcode, 0)
+        stats = snapshots.Stats()
+        self.assertEqual(stats['read'], n_read)
+        self.assertEqual(stats['read'] + stats['skipped'],
+                         snapshots.read_seq)
+
+    def testTornRead(self):
+        n_pends = 3
+        snapshots = pend.SnapshotBuffer(n_pends, n_buffers=2)
+        for slot in snapshots.slots:
+            slot[2] = InterruptedList(slot[2])
+        snapshots.Publish([1.0] * n_pends, [1.0] * n_pends, 1)
+        # The writer reuses the slot between the copies of the angles and
+        # the speeds.
+        def Overwrite():
+            for steps in [2, 3]:
+                values = [float(steps)] * n_pends
+                snapshots.Publish(values, values, steps)
+        snapshots.slots[1][2].hook = Overwrite
+        angles, speeds = snapshots.Latest()
+        self.assertEqual(snapshots.steps, 3)
+        self.assertEqual(angles, [3.0] * n_pends)
+        self.assertEqual(speeds, [3.0] * n_pends)
+        self.assertEqual(snapshots.Stats()['torn'], 1)
+
+    def testSharedTornRead(self):
+        n_pends = 3
+        snapshots = pend.SharedSnapshotBuffer(n_pends, n_buffers=2)
+        # On a single core the writer process seldom preempts a copy, so
+        # the slot is rewritten half way through one deliberately.
+        snapshots.data = InterruptedArray(snapshots.data)
+        snapshots.Publish([1.0] * n_pends, [1.0] * n_pends, 1)
+        def Overwrite():
+            for steps in [2, 3]:
+                values = [float(steps)] * n_pends
+                snapshots.Publish(values, values, steps)
+        snapshots.data.hook = Overwrite
+        angles, speeds = snapshots.Latest()
+        self.assertEqual(snapshots.steps, 3)
+        self.assertEqual(angles, [3.0] * n_pends)
+        self.assertEqual(speeds, [3.0] * n_pends)
+        self.assertEqual(snapshots.Stats()['torn'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+#
+"""Tests of the synthesizer (tune.py), driven through the sinks of
+sinks.py rather than a sound card.  Run with python -m unittest
+test_tune."""
+#
+#
+# Copyright 2017 David Talkin.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+__author__ = 'dtalkin@gmail.com (David Talkin)'
+
+import sys
+import time
+import array
+import unittest
+import sinks
+import tune
+
+
+class PeakSink(sinks.NullSink):
+    """A NullSink that keeps the peak absolute sample value."""
+
+    def __init__(self, rate=0.0):
+        sinks.NullSink.__init__(self, rate)
+        self.peak = 0
+
+    def Consume(self, data):
+        samples = array.array('h', bytes(data))
+        if samples:
+            self.peak = max(self.peak, max(samples), -min(samples))
+
+
+class SinkTest(unittest.TestCase):
+
+    def testStdoutRedirectedOnlyWhileOpen(self):
+        stdout = sys.stdout
+        sink = sinks.MakeSink('stdout')
+        self.assertTrue(sys.stdout is stdout)
+        sink.Open(lambda *args: ('', sinks.COMPLETE), 22050.0, 128)
+        self.assertTrue(sys.stdout is sys.stderr)
+        self.assertTrue(sink.out is stdout)
+        sink.Close()
+        self.assertTrue(sys.stdout is stdout)
+
+
+class MusicTest(unittest.TestCase):
+
+    def testPyAudioInstance(self):
+        audio = object()
+        music = tune.Music(audio)
+        self.assertTrue(isinstance(music.sink, sinks.PyAudioSink))
+        self.assertTrue(music.sink.audio is audio)
+        sink = sinks.NullSink()
+        self.assertTrue(tune.Music(sink).sink is sink)
+
+    def testRenderToNullSink(self):
+        sink = PeakSink()
+        music = tune.Music(sink, tonic='C4')
+        music.SetupProgression(chord_seq=['I', 'IV', 'V'], n_semitones=24)
+        music.OpenAudio()
+        music.ChangeChord(0)
+        music.tone_gen.SetupPings(sorted(music.chords[0]), .7, 2.0)
+        music.Ping(0)
+        n_samps = int(music.fs)
+        end = time.time() + 30.0
+        while sink.n_samps < n_samps and time.time() < end:
+            time.sleep(0.01)
+        music.StopAudioOutput()
+        self.assertTrue(sink.n_samps >= n_samps)
+        self.assertEqual(sink.n_samps % music.n_frames, 0)
+        self.assertEqual(music.tone_gen.sample_count, sink.n_samps)
+        self.assertEqual(sink.n_underflows, 0)
+        self.assertTrue(sink.peak > 0)
+
+    def testPrecomputedPingTables(self):
+        music = tune.Music(sinks.NullSink())
+        tonics = tune.Notes('C3', 1).c_sharp_names
+        music.PrecomputeProgressions(tonics, ['I', 'IV', 'V'], 24,
+                                     range(3, 8))
+        self.assertEqual(len(music.ping_tables), 12 * 3 * 5)
+        music.SetupProgression(['I', 'IV', 'V'], 'F#', 24)
+        music.MakeChordCompatiblePingNotes(2, 7)
+        self.assertEqual(len(music.ping_tables), 12 * 3 * 5)
+        self.assertTrue(music.tone_gen.ping_notes is music.ping_tables[
+            (('I', 'IV', 'V'), 'F#', 24, 2, 7)])
+
+    def testEventTimeAheadOfSynthesis(self):
+        music = tune.Music(sinks.NullSink(), tonic='C4')
+        music.SetupProgression(chord_seq=['I', 'IV', 'V'], n_semitones=24)
+        music.audio_on = True
+        music.HandleAudioOutput(None, music.n_frames, None, 0)
+        self.assertTrue(music.EventTime() >= music.tone_gen.sample_count)
+        music.SetProducer(4)
+        music.ring = tune.AudioRing(music.lookahead * music.n_frames)
+        music.ring_base = music.tone_gen.sample_count
+        music.FillRing()
+        for block in range(3):
+            music.HandleAudioOutput(None, music.n_frames, None, 0)
+            music.FillRing()
+            self.assertTrue(music.EventTime() >=
+                            music.tone_gen.sample_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
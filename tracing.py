@@ -0,0 +1,128 @@
+#!/usr/bin/python
+#
+"""Opt-in timeline tracing.  Instrumented code records begin, end and
+instant events, stamped with the time and thread, into a preallocated
+ring buffer; Export() writes the buffer as Chrome trace-event JSON,
+which chrome://tracing or https://ui.perfetto.dev display as one
+timeline per thread.
+
+Tracing is off until Enable() is called.  Call sites test the module
+flag first:
+
+    if tracing.enabled:
+        tracing.Begin('Tones.GetSamples')
+
+so that when it is off the cost is one attribute lookup.  When the
+buffer is full the oldest events are overwritten.  Events recorded in
+another process (e.g. the pendulum worker) stay in that process."""
+#
+#
+# Copyright 2017 David Talkin.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+__author__ = 'dtalkin@gmail.com (David Talkin)'
+
+import os
+import sys
+import time
+import json
+import thread
+import threading
+import itertools
+
+enabled = False
+events = []
+counter = itertools.count()
+capacity = 0
+thread_names = {}
+
+
+def Enable(n_events=65536):
+    """Start recording into a fresh buffer of n_events slots."""
+    global enabled, events, counter, capacity
+    enabled = False
+    events = [None] * n_events
+    capacity = n_events
+    counter = itertools.count()
+    thread_names.clear()
+    enabled = True
+
+
+def Disable():
+    """Stop recording.  The buffer is kept for Export()."""
+    global enabled
+    enabled = False
+
+
+def Record(phase, name, args):
+    tid = thread.get_ident()
+    if tid not in thread_names:
+        thread_names[tid] = threading.current_thread().name
+    events[next(counter) % capacity] = (phase, name, time.time(), tid, args)
+
+
+def Begin(name, args=None):
+    Record('B', name, args)
+
+
+def End(name, args=None):
+    Record('E', name, args)
+
+
+def Instant(name, args=None):
+    Record('i', name, args)
+
+
+def Events():
+    """Return the recorded events, oldest first, as tuples of (phase,
+    name, time, thread id, args)."""
+    ring = [e for e in events if e is not None]
+    ring.sort(key=lambda e: e[2])
+    return ring
+
+
+def ChromeTrace():
+    """Return the recorded events as a Chrome trace-event dict.  Ends
+    whose begins were overwritten are dropped."""
+    pid = os.getpid()
+    trace_events = []
+    depth = {}
+    for phase, name, t, tid, args in Events():
+        if phase == 'B':
+            depth[tid] = depth.get(tid, 0) + 1
+        elif phase == 'E':
+            if not depth.get(tid):
+                continue
+            depth[tid] -= 1
+        event = {'name': name, 'ph': phase, 'ts': t * 1.0e6, 'pid': pid,
+                 'tid': tid}
+        if phase == 'i':
+            event['s'] = 't'
+        if args:
+            event['args'] = args
+        trace_events.append(event)
+    for tid, thread_name in thread_names.items():
+        trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                             'tid': tid, 'args': {'name': thread_name}})
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def Export(file_name):
+    """Write the recorded events to file_name as Chrome trace JSON."""
+    try:
+        with open(file_name, 'w') as out:
+            json.dump(ChromeTrace(), out)
+    except IOError as e:
+        sys.stderr.write('Cannot write trace to %s: %s\n' % (file_name, e))
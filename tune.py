@@ -23,9 +23,21 @@ __author__ = 'dtalkin@gmail.com (David Talkin)'
 import sys
 import math
 import array
-import pyaudio
 import time
 import random
+import wave
+import struct
+import threading
+import heapq
+import collections
+import itertools
+import sinks
+import metrics
+import tracing
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 def MakeMajorChords(n_semis, base_i):
     """Given a count of notes ascending by semitones, and an index into
@@ -245,11 +257,131 @@ class Notes(object):
             print self.names[i], self.notes[i]
 
 
+class WaveTable(object):
+    """One cycle of a periodic waveform sampled at 2**bits points and read
+    with a 32-bit fixed-point phase, using linear or cubic interpolation
+    between table points.  It gives the 'table' chord engine of Tones
+    timbres other than a sine; it is not faster than math.sin, nor than
+    the 'numpy' engine.  Tables are shared: Get() returns the same
+    instance to every caller asking for the same harmonics."""
+    tables = {}
+    phase_bits = 32
+
+    def __init__(self, harmonics=(1.0,), bits=12):
+        """Args:
+            harmonics: relative amplitudes of the fundamental and its
+                       overtones; the waveform is normalized to a peak of 1.
+            bits: log2 of the number of points in one cycle.
+        """
+        self.harmonics = tuple(harmonics)
+        self.bits = bits
+        self.size = 1 << bits
+        self.frac_bits = WaveTable.phase_bits - bits
+        self.frac_mask = (1 << self.frac_bits) - 1
+        self.frac_scale = 1.0 / (1 << self.frac_bits)
+        self.phase_mask = (1 << WaveTable.phase_bits) - 1
+        self.to_phase = (1 << WaveTable.phase_bits) / (2.0 * math.pi)
+        wave = []
+        for i in range(self.size):
+            arg = 2.0 * math.pi * i / self.size
+            val = 0.0
+            for h in range(len(self.harmonics)):
+                val += self.harmonics[h] * math.sin((h + 1) * arg)
+            wave.append(val)
+        peak = max([abs(v) for v in wave])
+        if peak > 0.0:
+            wave = [v / peak for v in wave]
+        # Guard points so that index i of the wave is at i + 1 in the table
+        # and cubic interpolation never needs to wrap.
+        self.table = [wave[-1]] + wave + wave[:2]
+        if np is not None:
+            self.array = np.array(self.table)
+
+    @staticmethod
+    def Get(harmonics=(1.0,), bits=12):
+        key = (tuple(harmonics), bits)
+        if key not in WaveTable.tables:
+            WaveTable.tables[key] = WaveTable(harmonics, bits)
+        return WaveTable.tables[key]
+
+    def ToPhase(self, radians):
+        """Convert an angle in radians to a fixed-point phase."""
+        return int(radians * self.to_phase) & self.phase_mask
+
+    def ToRadians(self, phase):
+        return phase / self.to_phase
+
+    def Render(self, phases, incs, amps, n_samp, interpolation='linear'):
+        """Sum n_samp samples of len(phases) oscillators reading this
+        table.  phases and incs are fixed-point.  Returns the summed block
+        and the advanced phases."""
+        if np is not None:
+            return self.RenderArray(phases, incs, amps, n_samp,
+                                    interpolation)
+        table = self.table
+        output = [0.0 for i in range(n_samp)]
+        new_phases = []
+        for v in range(len(phases)):
+            phase = phases[v]
+            inc = incs[v]
+            amp = amps[v]
+            for i in range(n_samp):
+                ind = (phase >> self.frac_bits) + 1
+                frac = (phase & self.frac_mask) * self.frac_scale
+                p1 = table[ind]
+                p2 = table[ind + 1]
+                if interpolation == 'cubic':
+                    p0 = table[ind - 1]
+                    p3 = table[ind + 2]
+                    val = p1 + (0.5 * frac *
+                                (p2 - p0 + frac *
+                                 ((2.0 * p0) - (5.0 * p1) + (4.0 * p2) - p3 +
+                                  frac * ((3.0 * (p1 - p2)) + p3 - p0))))
+                else:
+                    val = p1 + (frac * (p2 - p1))
+                output[i] += amp * val
+                phase = (phase + inc) & self.phase_mask
+            new_phases.append(phase)
+        return output, new_phases
+
+    def RenderArray(self, phases, incs, amps, n_samp, interpolation='linear'):
+        """The numpy version of Render()."""
+        phases = np.array(phases, dtype=np.int64)
+        incs = np.array(incs, dtype=np.int64)
+        ph = ((phases[:, np.newaxis] + (incs[:, np.newaxis] *
+                                        np.arange(n_samp, dtype=np.int64)))
+              & self.phase_mask)
+        ind = (ph >> self.frac_bits) + 1
+        frac = (ph & self.frac_mask) * self.frac_scale
+        table = self.array
+        p1 = table[ind]
+        p2 = table[ind + 1]
+        if interpolation == 'cubic':
+            p0 = table[ind - 1]
+            p3 = table[ind + 2]
+            vals = p1 + (0.5 * frac *
+                         (p2 - p0 + frac *
+                          ((2.0 * p0) - (5.0 * p1) + (4.0 * p2) - p3 +
+                           frac * ((3.0 * (p1 - p2)) + p3 - p0))))
+        else:
+            vals = p1 + (frac * (p2 - p1))
+        output = np.dot(np.asarray(amps, dtype=np.float64), vals)
+        new_phases = (phases + (incs * n_samp)) & self.phase_mask
+        return output, new_phases.tolist()
+
+
 class Tones(object):
     """A class to generate and manipulate musical signals."""
 
-    def __init__(self, sample_rate):
+    def __init__(self, sample_rate, chord_engine='python',
+                 ping_engine='python'):
         self.fs = sample_rate
+        self.chord_engine = chord_engine
+        self.ping_engine = ping_engine
+        self.ping_powers = None
+        self.ping_powers_key = None
+        self.wave_table = None
+        self.interpolation = 'linear'
         self.notes = []
         self.args  = []
         self.incs = []
@@ -269,6 +401,15 @@ class Tones(object):
         self.ping_is_on = True
         self.chord_is_on = True
         self.detune_is_on = True
+        self.rng = random.Random()
+        self.sample_count = 0
+        self.events = []
+        self.new_events = collections.deque()
+        self.event_seq = itertools.count()
+
+    def SetSeed(self, seed):
+        """Make the random detuning of the pings reproducible."""
+        self.rng = random.Random(seed)
 
     def ToggleDetune(self):
         self.detune_is_on = not self.detune_is_on
@@ -279,6 +420,56 @@ class Tones(object):
     def ToggleChord(self):
         self.chord_is_on = not self.chord_is_on
 
+    def SetChordEngine(self, engine):
+        """Select how the chord is synthesized.  'python' computes each
+        sample of each note with math.sin; 'numpy' keeps the chord phases,
+        increments and amplitudes in arrays and renders a whole block in
+        one vectorized pass; 'table' reads the shared wave table set by
+        SetWaveTable(), for timbres other than a sine.  The table is no
+        faster than math.sin in pure Python."""
+        if engine == 'numpy' and np is None:
+            sys.stderr.write('numpy is not available; using the python '
+                             'chord engine.\n')
+            engine = 'python'
+        if engine not in ['python', 'numpy', 'table']:
+            sys.stderr.write('Unknown chord engine (%s)\n' % (engine))
+            return
+        self.chord_engine = engine
+        if engine == 'numpy':
+            self.args = np.array(self.args, dtype=np.float64)
+            self.incs = np.array(self.incs, dtype=np.float64)
+            self.amps = np.array(self.amps, dtype=np.float64)
+        else:
+            self.args = [float(a) for a in self.args]
+            self.incs = [float(a) for a in self.incs]
+            self.amps = [float(a) for a in self.amps]
+
+    def SetPingEngine(self, engine):
+        """Select how the pings are synthesized.  'python' computes each
+        sample of each ping with math.sin; 'resonator' treats each ping as
+        a decaying complex rotator, so that a voice advances by a complex
+        multiply per sample and all ringing voices are stepped together."""
+        if engine not in ['python', 'resonator']:
+            sys.stderr.write('Unknown ping engine (%s)\n' % (engine))
+            return
+        self.ping_engine = engine
+
+    def SetWaveTable(self, harmonics=(1.0,), interpolation='linear',
+                     bits=12):
+        """Choose the waveform read by the 'table' chord engine.
+        harmonics are the relative amplitudes of the fundamental and its
+        overtones.  interpolation is 'linear' or 'cubic'."""
+        if interpolation not in ['linear', 'cubic']:
+            sys.stderr.write('Unknown interpolation (%s)\n' % (interpolation))
+            return
+        self.wave_table = WaveTable.Get(harmonics, bits)
+        self.interpolation = interpolation
+
+    def GetWaveTable(self):
+        if not self.wave_table:
+            self.wave_table = WaveTable.Get()
+        return self.wave_table
+
     def ResetPings(self, max_notes):
         self.ping_notes = [0.0 for i in range(max_notes)]
         self.ping_args = [0.0 for i in range(max_notes)]
@@ -297,6 +488,8 @@ class Tones(object):
         amp = 6000.0 / max_notes
         self.amps = [amp for i in range(max_notes)]
         self.n_notes = 0
+        if self.chord_engine != 'python':
+            self.SetChordEngine(self.chord_engine)
 
     def SetupPings(self, ping_notes, time_const=0.5, dur=1.0):
         if len(ping_notes) > self.n_pings:
@@ -307,13 +500,15 @@ class Tones(object):
         self.ping_decay = math.exp(-1.0 / (time_const * self.fs))
         for i in range(len(ping_notes)):
             if self.detune_is_on:
-                freq = (8.0 * (random.random() - 0.5)) + ping_notes[i]
+                freq = (8.0 * (self.rng.random() - 0.5)) + ping_notes[i]
             else:
                 freq = ping_notes[i]
             self.ping_incs[i] = pi2 * freq / self.fs
         self.n_pings = len(ping_notes)
 
     def Ping(self, ping_ind, new_ping_freq=None):
+        if tracing.enabled:
+            tracing.Instant('ping', {'ind': ping_ind})
         if new_ping_freq:
             self.ping_incs[ping_ind] = 2.0 * math.pi * new_ping_freq / self.fs
         self.ping_amps[ping_ind] = self.ping_reset_amp
@@ -321,6 +516,8 @@ class Tones(object):
         self.ping_args[ping_ind] = 0.0
 
     def ChangeChord(self, new_notes):
+        if tracing.enabled:
+            tracing.Instant('chord', {'notes': list(new_notes)})
         if len(new_notes) > len(self.notes):
             self.ResetChord(len(new_notes))
         self.notes = new_notes
@@ -332,7 +529,76 @@ class Tones(object):
     def SetupGenreator(self, notes):
         self.ChangeChord(notes)
 
+    def GetPingPowers(self, n_samp):
+        """Return an n_pings x n_samp array whose row v holds the powers
+        r**k, k = 0 .. n_samp-1, of the complex rotator r of ping v.  The
+        table only depends on the ping frequencies, the decay and the block
+        size, so it is cached until one of those changes."""
+        key = (n_samp, self.ping_decay, tuple(self.ping_incs[:self.n_pings]))
+        if key != self.ping_powers_key:
+            incs = np.array(self.ping_incs[:self.n_pings], dtype=np.float64)
+            log_r = math.log(self.ping_decay) + (1j * incs)
+            self.ping_powers = np.exp(np.outer(log_r, np.arange(n_samp)))
+            self.ping_powers_key = key
+        return self.ping_powers
+
+    def GenerateResonatorPings(self, n_samp):
+        """Generate the ping signal with each ping modeled as a complex
+        rotator z[k+1] = r * z[k], r = decay * exp(j * inc), whose imaginary
+        part is the decaying sinusoid.  Pings that have run their course
+        are skipped entirely."""
+        pi2 = math.pi * 2.0
+        decay = self.ping_decay
+        active = [p for p in range(self.n_pings)
+                  if self.ping_inds[p] < self.ping_samples]
+        if np is None:
+            output = [0.0 for i in range(n_samp)]
+            for ping in active:
+                ngen = min(n_samp, self.ping_samples - self.ping_inds[ping])
+                rot = decay * complex(math.cos(self.ping_incs[ping]),
+                                      math.sin(self.ping_incs[ping]))
+                z = self.ping_amps[ping] * complex(
+                    math.cos(self.ping_args[ping]),
+                    math.sin(self.ping_args[ping]))
+                for i in range(ngen):
+                    output[i] += z.imag
+                    z *= rot
+                self.ping_amps[ping] = abs(z)
+                self.ping_args[ping] = math.atan2(z.imag, z.real) % pi2
+                self.ping_inds[ping] += ngen
+            return output
+        output = np.zeros(n_samp)
+        if not active:
+            return output
+        powers = self.GetPingPowers(n_samp)
+        full = [p for p in active
+                if (self.ping_samples - self.ping_inds[p]) >= n_samp]
+        if full:
+            amps = np.array([self.ping_amps[p] for p in full])
+            args = np.array([self.ping_args[p] for p in full])
+            if len(full) < self.n_pings:
+                rows = powers[full]
+            else:
+                rows = powers
+            output += (np.dot(amps * np.cos(args), rows.imag) +
+                       np.dot(amps * np.sin(args), rows.real))
+        for ping in active:
+            ngen = min(n_samp, self.ping_samples - self.ping_inds[ping])
+            arg = self.ping_args[ping]
+            amp = self.ping_amps[ping]
+            if ngen < n_samp:
+                row = powers[ping, :ngen]
+                output[:ngen] += ((amp * math.cos(arg) * row.imag) +
+                                  (amp * math.sin(arg) * row.real))
+            self.ping_amps[ping] = amp * pow(decay, ngen)
+            self.ping_args[ping] = math.fmod(arg + (self.ping_incs[ping] *
+                                                    ngen), pi2)
+            self.ping_inds[ping] += ngen
+        return output
+
     def GeneratePingSignal(self, n_samp):
+        if self.ping_engine == 'resonator' and self.ping_is_on:
+            return self.GenerateResonatorPings(n_samp)
         output = [0.0 for i in range(n_samp)]
         if not self.ping_is_on:
             return output
@@ -354,7 +620,117 @@ class Tones(object):
             self.ping_inds[ping] += ngen
         return output
 
+    def GenerateChordBlock(self, n_samp):
+        """Render n_samp samples of the current chord as a numpy array.
+        The phase of each note at sample k is computed directly as
+        args + k * incs, which matches the per-sample accumulation in
+        GetSamples to within rounding."""
+        n = self.n_notes
+        if (not self.chord_is_on) or (n == 0):
+            return np.zeros(n_samp)
+        pi2 = 2.0 * math.pi
+        args = self.args[:n]
+        incs = self.incs[:n]
+        phases = args[:, np.newaxis] + (incs[:, np.newaxis] *
+                                        np.arange(n_samp))
+        block = np.dot(self.amps[:n], np.sin(phases))
+        self.args[:n] = np.fmod(args + (incs * n_samp), pi2)
+        return block
+
+    def GenerateTableChord(self, n_samp):
+        """Render n_samp samples of the current chord from the wave
+        table.  The phases stay in radians in self.args, as for the other
+        engines, and are converted to fixed point for each block, so that
+        the engine can be changed between any two blocks."""
+        n = self.n_notes
+        if (not self.chord_is_on) or (n == 0):
+            return [0.0 for i in range(n_samp)]
+        table = self.GetWaveTable()
+        phases = [table.ToPhase(a) for a in self.args[:n]]
+        incs = [table.ToPhase(a) for a in self.incs[:n]]
+        block, phases = table.Render(phases, incs, self.amps[:n], n_samp,
+                                     self.interpolation)
+        for i in range(n):
+            self.args[i] = table.ToRadians(phases[i])
+        return block
+
+    def Schedule(self, when, method, *args):
+        """Arrange for self.<method>(*args) to be applied just before the
+        sample numbered when (counted from the first sample ever produced)
+        is generated.  Events for samples already generated are applied at
+        the start of the next block.  This may be called from any
+        thread."""
+        self.new_events.append((when, next(self.event_seq), method, args))
+
+    def ClearEvents(self):
+        self.new_events.clear()
+        self.events = []
+
+    def RunEvents(self, n_samp, render):
+        """Advance n_samp samples, applying each scheduled event at its
+        exact sample offset.  render(offset, n) is called to generate each
+        span of n samples between events, offset being its position in
+        the block."""
+        while self.new_events:
+            heapq.heappush(self.events, self.new_events.popleft())
+        start = self.sample_count
+        end = start + n_samp
+        while self.events and self.events[0][0] < end:
+            when, seq, method, args = heapq.heappop(self.events)
+            if when > self.sample_count:
+                render(self.sample_count - start, when - self.sample_count)
+                self.sample_count = when
+            getattr(self, method)(*args)
+        if end > self.sample_count:
+            render(self.sample_count - start, end - self.sample_count)
+        self.sample_count = end
+
     def GetSamples(self, n_samp):
+        """Generate the next n_samp samples as a list of ints, applying
+        each scheduled event at its exact sample offset within the
+        block."""
+        if tracing.enabled:
+            tracing.Begin('Tones.GetSamples')
+        sig = []
+        self.RunEvents(n_samp,
+                       lambda offset, n: sig.extend(self.GenerateSamples(n)))
+        if tracing.enabled:
+            tracing.End('Tones.GetSamples')
+        return sig
+
+    def FillInt16(self, out, n_samp):
+        """Generate the next n_samp samples, clipped to int16, directly into
+        the Int16Buffer out, and return its data."""
+        if tracing.enabled:
+            tracing.Begin('Tones.FillInt16')
+        out.Resize(n_samp)
+        self.RunEvents(n_samp,
+                       lambda offset, n: out.Put(offset,
+                                                 self.GenerateBlock(n)))
+        if tracing.enabled:
+            tracing.End('Tones.FillInt16')
+        return out.data
+
+    def GenerateBlock(self, n_samp):
+        """Generate n_samp samples, unrounded and unclipped.  The result is
+        a numpy array when numpy is used, otherwise a list."""
+        if self.chord_engine == 'numpy':
+            return (np.array(self.GeneratePingSignal(n_samp)) +
+                    self.GenerateChordBlock(n_samp))
+        if self.chord_engine == 'table':
+            pings = self.GeneratePingSignal(n_samp)
+            chord = self.GenerateTableChord(n_samp)
+            if np is not None:
+                return np.asarray(pings) + chord
+            return [pings[i] + chord[i] for i in range(n_samp)]
+        return self.GenerateSamples(n_samp)
+
+    def GenerateSamples(self, n_samp):
+        if self.chord_engine != 'python':
+            sig = self.GenerateBlock(n_samp)
+            if np is not None:
+                return np.asarray(sig).astype(np.int32).tolist()
+            return [int(s) for s in sig]
         pi2 = 2.0 * math.pi
         sig = [0 for i in range(n_samp)]
         pings = self.GeneratePingSignal(n_samp)
@@ -367,11 +743,145 @@ class Tones(object):
             sig[i] = int(sum)
         return sig
 
+def MeasureThroughput(tone_gen, n_samp=2048, n_blocks=50):
+    """Time repeated calls to tone_gen.GetSamples(n_samp) and return the
+    synthesis rate in samples per second."""
+    tone_gen.GetSamples(n_samp)
+    time1 = time.time()
+    for i in range(n_blocks):
+        tone_gen.GetSamples(n_samp)
+    time2 = time.time()
+    return n_samp * n_blocks / max(time2 - time1, 1.0e-9)
+
+
+def ClipSamples(samples):
+    """Limit samples to the int16 range."""
+    return [max(-32768, min(32767, int(s))) for s in samples]
+
+
+class WavWriter(object):
+    """Streams blocks of samples to a mono 16-bit WAV file.  Nothing is
+    accumulated in memory; the header is completed when the file is
+    closed."""
+
+    def __init__(self, file_name, sample_rate):
+        self.file_name = file_name
+        self.wav = wave.open(file_name, 'wb')
+        self.wav.setnchannels(1)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(int(sample_rate))
+        self.n_written = 0
+
+    def Write(self, samples):
+        self.WriteData(array.array('h', ClipSamples(samples)).tostring())
+
+    def WriteData(self, data):
+        """Write int16 sample data."""
+        self.wav.writeframes(bytes(data))
+        self.n_written += len(data) // 2
+
+    def Close(self):
+        if self.wav:
+            self.wav.close()
+            self.wav = None
+
+
+class Int16Buffer(object):
+    """A reusable buffer of native int16 samples for the audio stream.
+    Blocks are clipped and converted into it in place; with numpy the
+    conversion goes through a preallocated float scratch array, so a
+    callback allocates nothing here beyond what synthesis itself
+    needs."""
+
+    def __init__(self, n_samps=0):
+        self.n_samps = -1
+        self.n_clipped = 0
+        self.Resize(n_samps)
+
+    def Resize(self, n_samps):
+        if n_samps == self.n_samps:
+            return
+        self.n_samps = n_samps
+        self.data = bytearray(2 * n_samps)
+        if np is not None:
+            self.samples = np.frombuffer(self.data, dtype=np.int16)
+            self.scratch = np.zeros(n_samps)
+
+    def Put(self, offset, block):
+        """Store block, clipped to the int16 range, at sample offset."""
+        n = len(block)
+        if np is not None:
+            scratch = self.scratch[offset:offset + n]
+            np.clip(block, -32768.0, 32767.0, out=scratch)
+            self.n_clipped += n - np.count_nonzero(scratch == block)
+            self.samples[offset:offset + n] = scratch
+            return
+        clipped = ClipSamples(block)
+        self.n_clipped += sum(1 for i in range(n)
+                              if clipped[i] != int(block[i]))
+        struct.pack_into('%dh' % n, self.data, 2 * offset, *clipped)
+
+
+class AudioRing(object):
+    """A preallocated ring buffer of int16 samples, written by one
+    producer thread and read by the audio callback.  write_count and
+    read_count are running totals of samples, each advanced by one side
+    only."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = bytearray(2 * capacity)
+        self.view = memoryview(self.data)
+        self.out = bytearray(0)
+        self.write_count = 0
+        self.read_count = 0
+        self.n_underruns = 0
+
+    def Free(self):
+        return self.capacity - (self.write_count - self.read_count)
+
+    def Write(self, samples):
+        """Append samples, which must fit in Free()."""
+        self.WriteData(array.array('h', ClipSamples(samples)).tostring())
+
+    def WriteData(self, data):
+        """Append int16 sample data, which must fit in Free()."""
+        start = 2 * (self.write_count % self.capacity)
+        first = min(len(data), len(self.data) - start)
+        self.data[start:start + first] = data[:first]
+        if first < len(data):
+            self.data[0:len(data) - first] = data[first:]
+        self.write_count += len(data) // 2
+
+    def Read(self, n_samps):
+        """Return the next n_samps samples as int16 bytes.  The returned
+        buffer is reused by the next call.  Missing samples are filled with
+        silence and counted as an underrun."""
+        if len(self.out) != 2 * n_samps:
+            self.out = bytearray(2 * n_samps)
+        n = min(n_samps, self.write_count - self.read_count)
+        start = 2 * (self.read_count % self.capacity)
+        first = min(2 * n, len(self.data) - start)
+        self.out[0:first] = self.view[start:start + first]
+        if first < 2 * n:
+            self.out[first:2 * n] = self.view[0:(2 * n) - first]
+        if n < n_samps:
+            self.out[2 * n:] = bytearray(2 * (n_samps - n))
+            self.n_underruns += 1
+        self.read_count += n
+        return self.out
+
+
 class Music(object):
-    """A class to create sound from musical signals."""
+    """A class to create sound from musical signals.  The sound goes to
+    sink, an AudioSink from sinks.py, or through PyAudio if it is None.
+    A PyAudio instance, which was passed here before there were sinks,
+    is wrapped in a PyAudioSink."""
 
-    def __init__(self, audio, sample_rate=22050.0, tonic='A3'):
-        self.pyaudio = audio
+    def __init__(self, sink=None, sample_rate=22050.0, tonic='A3'):
+        if sink is not None and not isinstance(sink, sinks.AudioSink):
+            sink = sinks.PyAudioSink(sink)
+        self.sink = sink
         self.fs = sample_rate
         self.progression = ['I', 'iii', 'vi', 'V', 'I', 'vi', 'iii', 'IV', 'V']
         self.tonic = tonic
@@ -383,8 +893,137 @@ class Music(object):
         self.n_frames = 2048
         self.change_int = 3.0
         self.audio_on = False
-        self.pa_stream = None
         self.print_progression = False
+        self.ring = None
+        self.lookahead = 0
+        self.producer = None
+        self.producing = False
+        self.timestamped = False
+        self.ring_base = 0
+        self.callback_sample = 0
+        self.callback_time = 0.0
+        self.output_latency = 0.0
+        self.out = Int16Buffer()
+        self.progressions = {}
+        self.ping_tables = {}
+
+    def SetLowLatency(self, n_frames=128):
+        """Use small audio buffers of n_frames, and put pings and chord
+        changes in the synthesizer's event queue stamped with the sample
+        at which they should sound, rather than applying them at once at
+        a block boundary.  Takes effect at the next SetupAudioStream()."""
+        self.n_frames = n_frames
+        self.timestamped = True
+
+    def SetProducer(self, lookahead=4):
+        """Synthesize in a separate producer thread that keeps up to
+        lookahead blocks of n_frames rendered ahead in an AudioRing, so
+        that the audio callback only copies samples out of the ring.  Pings
+        are then played a fixed lookahead after they are requested.  A
+        lookahead of 0 synthesizes in the callback again.  Takes effect
+        at the next SetupAudioStream()."""
+        self.lookahead = lookahead
+
+    def StartProducer(self):
+        self.ring = AudioRing(self.lookahead * self.n_frames)
+        self.ring_base = self.tone_gen.sample_count
+        self.callback_sample = self.ring_base
+        self.callback_time = time.time()
+        self.FillRing()
+        self.producing = True
+        self.producer = threading.Thread(group=None, target=self.RunProducer)
+        self.producer.daemon = True
+        self.producer.start()
+
+    def StopProducer(self):
+        self.producing = False
+        if self.producer:
+            self.producer.join()
+            self.producer = None
+        self.ring = None
+
+    def FillRing(self):
+        while self.ring.Free() >= self.n_frames:
+            time1 = time.time()
+            self.ring.WriteData(self.tone_gen.FillInt16(self.out,
+                                                        self.n_frames))
+            self.RecordRenderTime(time1, self.n_frames)
+
+    def RunProducer(self):
+        while self.producing:
+            self.FillRing()
+            time.sleep(0.25 * self.n_frames / self.fs)
+
+    def LatencySamples(self):
+        """The output latency of the stream, in samples."""
+        return int(self.output_latency * self.fs)
+
+    def CurrentSample(self):
+        """Estimate the index of the sample being played now.  Each audio
+        callback notes the time, the index of the first sample it hands
+        over and the stream's output latency, which PortAudio reports as
+        the time until that sample reaches the DAC.  The sample playing
+        now is then that one, less the latency, plus the time since the
+        callback, all in samples."""
+        return (self.callback_sample - self.LatencySamples() +
+                int((time.time() - self.callback_time) * self.fs))
+
+    def EventTime(self):
+        """Return the sample at which an event requested now should
+        apply.  Its offset from CurrentSample() is the least that is sure
+        to be in the future of the synthesizer: the output latency, plus
+        the buffer of the next callback and, with a producer, the ring,
+        which the producer refills once that buffer has been read."""
+        if self.ring:
+            ahead = self.ring.capacity + self.n_frames
+        else:
+            ahead = self.n_frames
+        return self.CurrentSample() + self.LatencySamples() + ahead
+
+    def UseEvents(self):
+        return self.audio_on and (self.timestamped or self.ring)
+
+    def Apply(self, method, *args):
+        """Call self.tone_gen.<method>(*args).  While the stream is running
+        the call goes through the synthesizer's event queue, so that the
+        audio thread makes it between blocks: at EventTime() with
+        timestamped events, otherwise at the start of the next block."""
+        if tracing.enabled:
+            tracing.Instant('Music.' + method)
+        if self.UseEvents():
+            self.tone_gen.Schedule(self.EventTime(), method, *args)
+        elif self.audio_on:
+            self.tone_gen.Schedule(0, method, *args)
+        else:
+            getattr(self.tone_gen, method)(*args)
+
+    def CompileProgression(self, progression, tonic, n_semis):
+        """Return the Notes object, chord frequencies and chord note names
+        for progression in the key of tonic.  Results are cached, so each
+        combination is only parsed once."""
+        key = (tuple(progression), tonic, n_semis)
+        if key not in self.progressions:
+            note_gen = Notes(tonic, n_semis)
+            chords = [note_gen.ChordSpecToNotes(c) for c in progression]
+            names = [note_gen.ChordSpecToNoteNames(c) for c in progression]
+            self.progressions[key] = (note_gen, chords, names)
+        return self.progressions[key]
+
+    def PrecomputeProgressions(self, tonics, chord_seq=None,
+                               n_semitones=None, n_pings=()):
+        """Compile the progression (by default the current one) for each of
+        tonics ahead of time, along with the ping tables of each of its
+        chords for each count in n_pings, so that a later
+        SetupProgression() and MakeChordCompatiblePingNotes() with any of
+        them are table lookups."""
+        progression = chord_seq or self.progression
+        n_semis = n_semitones or self.n_semis
+        for tonic in tonics:
+            chords = self.CompileProgression(progression, tonic, n_semis)[1]
+            for chord_ind in range(len(chords)):
+                for count in n_pings:
+                    self.GetPingTable(progression, tonic, n_semis, chords,
+                                      chord_ind, count)
 
     def SetupProgression(self, chord_seq=None, tonic=None, n_semitones=None):
         if chord_seq:
@@ -395,12 +1034,8 @@ class Music(object):
             self.tonic = tonic
         if n_semitones:
             self.n_semis = n_semitones
-        self.chords = []
-        self.names = []
-        self.note_gen = Notes(self.tonic, self.n_semis)
-        for chord in self.progression:
-            self.chords.append(self.note_gen.ChordSpecToNotes(chord))
-            self.names.append(self.note_gen.ChordSpecToNoteNames(chord))
+        self.note_gen, self.chords, self.names = self.CompileProgression(
+            self.progression, self.tonic, self.n_semis)
 
     def TogglePrintProgression(self):
         self.print_progression = not self.print_progression
@@ -416,53 +1051,114 @@ class Music(object):
 
     def HandleAudioOutput(self, in_data, n_samps, time_info, status):
         if not self.audio_on:
-            return '', pyaudio.paComplete
-        data = array.array('h', self.tone_gen.GetSamples(n_samps)).tostring()
-        return data, pyaudio.paContinue
+            return '', sinks.COMPLETE
+        self.callback_time = time.time()
+        if time_info:
+            self.output_latency = max(
+                0.0, (time_info['output_buffer_dac_time'] -
+                      time_info['current_time']))
+        metrics.Count('audio.callbacks')
+        if status & sinks.OUTPUT_UNDERFLOW:
+            metrics.Count('audio.output_underflows')
+        if self.ring:
+            self.callback_sample = self.ring_base + self.ring.read_count
+            n_underruns = self.ring.n_underruns
+            data = self.ring.Read(n_samps)
+            if self.ring.n_underruns != n_underruns:
+                metrics.Count('audio.ring_underruns')
+        else:
+            self.callback_sample = self.tone_gen.sample_count
+            data = self.tone_gen.FillInt16(self.out, n_samps)
+            self.RecordRenderTime(self.callback_time, n_samps)
+        return data, sinks.CONTINUE
+
+    def RecordRenderTime(self, start, n_samps):
+        """Record the time since start taken to synthesize n_samps samples,
+        in seconds and as a fraction of the time they take to play.  A
+        load above 1 can not keep up.  With a producer ring this is timed
+        in the producer, not the callback."""
+        render_time = time.time() - start
+        load = render_time * self.fs / n_samps
+        metrics.Observe('audio.render_time', render_time)
+        metrics.Observe('audio.load', load)
+        if load > 1.0:
+            metrics.Count('audio.overloads')
+
+    def SetSink(self, sink):
+        """Send the audio to sink, an AudioSink from sinks.py, from the
+        next SetupAudioStream() on."""
+        self.StopAudioOutput()
+        self.sink = sink
 
     def SetupAudioStream(self):
         self.StopAudioOutput()
-        self.pa_stream = self.pyaudio.open(format=pyaudio.paInt16, start=False,
-                                           channels=1,
-                                           frames_per_buffer=self.n_frames,
-                                           rate=int(self.fs), output=True,
-                                        stream_callback=self.HandleAudioOutput)
+        if not self.sink:
+            self.sink = sinks.MakeSink('pyaudio')
+        self.sink.Open(self.HandleAudioOutput, self.fs, self.n_frames)
 
     def StopAudioOutput(self):
         if self.audio_on:
             self.audio_on = False
             time.sleep(1.5 * self.n_frames/self.fs)
-        if self.pa_stream:
-            self.pa_stream.close()
-            self.pa_stream = None
+        if self.sink:
+            self.sink.Close()
+        self.StopProducer()
 
     def StartAudio(self):
         if not self.audio_on:
+            if self.lookahead > 0:
+                self.StartProducer()
+            else:
+                self.callback_sample = self.tone_gen.sample_count
+                self.callback_time = time.time()
             self.audio_on = True
-            self.pa_stream.start_stream()
+            self.sink.Start()
+
+    def OpenAudio(self):
+        """Set up and start the stream unless it is already running.  The
+        stream can then stay open for the life of the program, with
+        changes of content going through Apply()."""
+        if not self.audio_on:
+            self.SetupAudioStream()
+            self.StartAudio()
 
     def ChangeChord(self, chord_ind):
         if self.print_progression:
             print self.progression[chord_ind], self.names[chord_ind]
-        self.tone_gen.ChangeChord(self.chords[chord_ind])
+        self.Apply('ChangeChord', self.chords[chord_ind])
+
+    def GetPingTable(self, progression, tonic, n_semis, chords, chord_ind,
+                     n_pings):
+        """Return n_pings ping notes from the notes of chords[chord_ind],
+        going up an octave each time they run out.  The tables are cached
+        per key, chord and number of pings."""
+        key = (tuple(progression), tonic, n_semis, chord_ind, n_pings)
+        pings = self.ping_tables.get(key)
+        if pings is None:
+            pingc = 0
+            multiplier = 1.0
+            pings = []
+            notes = chords[chord_ind]
+            while pingc <= n_pings:
+                for note in notes:
+                    pings.append(note * multiplier)
+                    pingc += 1
+                    if pingc >= n_pings:
+                        break
+                multiplier *= 2.0
+            pings.sort()
+            self.ping_tables[key] = pings
+        return pings
 
     def MakeChordCompatiblePingNotes(self, chord_ind, n_pings):
-        pingc = 0
-        multiplier = 1.0
-        pings = []
-        notes = self.chords[chord_ind]
-        while pingc <= n_pings:
-            for note in notes:
-                pings.append(note * multiplier)
-                pingc += 1
-                if pingc >= n_pings:
-                    break
-            multiplier *= 2.0
-        pings.sort()
-        self.tone_gen.SetupPings(pings, .5, 1.0)
+        """Set up n_pings ping notes for chord chord_ind, from the table
+        made by PrecomputeProgressions() if there is one."""
+        pings = self.GetPingTable(self.progression, self.tonic, self.n_semis,
+                                  self.chords, chord_ind, n_pings)
+        self.Apply('SetupPings', pings, .5, 1.0)
 
     def Ping(self, note_ind):
-        self.tone_gen.Ping(note_ind)
+        self.Apply('Ping', note_ind)
 
     def RepeatProgression(self, change_int=3.0, reps=1):
         self.SetupAudioStream()
@@ -480,18 +1176,71 @@ class Music(object):
                 #   notes.extend(notes)
                 #   random.shuffle(notes)
                 notes.sort()
-                self.tone_gen.SetupPings(notes, .7, 2.0)
+                self.Apply('SetupPings', notes, .7, 2.0)
                 self.StartAudio()
                 print self.progression[cind], '   ', self.names[cind]
                 for note in range(len(notes)):
-                    self.tone_gen.Ping(note)
+                    self.Ping(note)
                     time.sleep(self.change_int/len(notes))
                 cind = cind + 1
 
+    def RenderSamples(self, writer, n_samps):
+        """Generate n_samps samples and pass them to writer in blocks of
+        at most n_frames."""
+        while n_samps > 0:
+            n = min(n_samps, self.n_frames)
+            writer.WriteData(self.tone_gen.FillInt16(self.out, n))
+            n_samps -= n
+
+    def RenderProgression(self, file_name, change_int=3.0, reps=1):
+        """Render what RepeatProgression() would play to the WAV file
+        file_name.  Time is kept by counting samples rather than by the
+        wall clock, so this runs as fast as the synthesis allows and needs
+        no audio device."""
+        self.change_int = change_int
+        writer = WavWriter(file_name, self.fs)
+        t_sim = 0.0
+        for rep in range(reps):
+            for cind in range(len(self.progression)):
+                self.ChangeChord(cind)
+                notes = sorted(self.chords[cind])
+                self.tone_gen.SetupPings(notes, .7, 2.0)
+                for note in range(len(notes)):
+                    self.tone_gen.Ping(note)
+                    t_sim += self.change_int / len(notes)
+                    self.RenderSamples(writer, int(t_sim * self.fs) -
+                                       writer.n_written)
+        writer.Close()
+        return writer.n_written
+
+
 def main(args):
-    p = pyaudio.PyAudio()
-    m = Music(p, tonic='C4')
-    m.SetupProgression(chord_seq=args[1:], n_semitones=24)
+    chord_seq = args[1:]
+    if len(chord_seq) > 1 and chord_seq[0] == '-o':
+        m = Music(None, tonic='C4')
+        m.SetupProgression(chord_seq=chord_seq[2:], n_semitones=24)
+        m.RenderProgression(chord_seq[1], 2.0, 4)
+        return
+    sink_spec = 'pyaudio'
+    low_latency = False
+    lookahead = 0
+    while chord_seq and chord_seq[0] in ['-a', '-l', '-p']:
+        if chord_seq[0] == '-l':
+            low_latency = True
+            del chord_seq[0]
+            continue
+        if len(chord_seq) < 2:
+            break
+        if chord_seq[0] == '-a':
+            sink_spec = chord_seq[1]
+        else:
+            lookahead = int(chord_seq[1])
+        del chord_seq[0:2]
+    m = Music(sinks.MakeSink(sink_spec), tonic='C4')
+    if low_latency:
+        m.SetLowLatency()
+    m.SetProducer(lookahead)
+    m.SetupProgression(chord_seq=chord_seq, n_semitones=24)
     m.RepeatProgression(2.0, 4)
 
 if __name__ == '__main__':